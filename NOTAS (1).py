@@ -11,20 +11,31 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 from datetime import datetime, date
+from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 import re
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Union
 import io
+import os
 import ssl
+import hashlib
+import html
+from functools import lru_cache
+from pathlib import Path
 import warnings
 from sqlalchemy import create_engine
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import threading
 import time
 
+try:
+    import turbodbc  # Opcional: fetch Arrow nativo via ODBC
+except ImportError:
+    turbodbc = None
+
 # Configurações SSL
 try:
     _create_unverified_https_context = ssl._create_unverified_context
@@ -43,8 +54,10 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# CSS para reduzir espaço no topo da página
-st.markdown("""
+# CSS para reduzir espaço no topo da página.
+# Emitido a cada rerun: o Streamlit remove elementos não reemitidos no rerun,
+# então um guard em session_state faria o estilo sumir após a 1ª interação.
+CSS_LAYOUT = """
 <style>
     .block-container {
         padding-top: 1rem;
@@ -57,7 +70,8 @@ st.markdown("""
         padding-top: 1rem;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(CSS_LAYOUT, unsafe_allow_html=True)
 
 # =============================================================================
 # CONFIGURAÇÃO DO BANCO DE DADOS
@@ -66,6 +80,9 @@ IMPALA_HOST = 'bdaworkernode02.sef.sc.gov.br'
 IMPALA_PORT = 21050
 IMPALA_USER = st.secrets["impala_credentials"]["user"]
 IMPALA_PASSWORD = st.secrets["impala_credentials"]["password"]
+IMPALA_ODBC_DSN = st.secrets.get("impala_odbc", {}).get("dsn")
+QUERY_MAX_WORKERS = 8
+LEITURA_CHUNKSIZE = 100_000  # linhas por bloco em pd.read_sql
 
 @st.cache_resource
 def get_impala_engine():
@@ -78,20 +95,119 @@ def get_impala_engine():
                 'password': IMPALA_PASSWORD,
                 'auth_mechanism': 'LDAP',
                 'use_ssl': True
-            }
+            },
+            # Pool dimensionado para as queries disparadas em paralelo
+            pool_size=QUERY_MAX_WORKERS,
+            max_overflow=4,
+            pool_pre_ping=True
         )
         return engine
     except Exception as e:
         st.error(f"❌ Erro ao criar engine Impala: {e}")
         return None
 
+@st.cache_resource
+def _turbodbc_local() -> threading.local:
+    """Armazenamento por thread das conexões turbodbc, compartilhado entre reruns
+    (o Streamlit reexecuta o script a cada interação; um threading.local em nível
+    de módulo seria recriado e forçaria nova conexão a cada rerun)."""
+    return threading.local()
+
+def get_turbodbc_conn():
+    """Retorna conexão turbodbc da thread atual (None se não disponível/configurada)."""
+    if turbodbc is None or not IMPALA_ODBC_DSN:
+        return None
+    local = _turbodbc_local()
+    conn = getattr(local, 'conn', None)
+    if conn is None:
+        conn = turbodbc.connect(dsn=IMPALA_ODBC_DSN, uid=IMPALA_USER, pwd=IMPALA_PASSWORD)
+        local.conn = conn
+    return conn
+
+def descartar_turbodbc_conn():
+    """Fecha e esquece a conexão turbodbc da thread atual (ex.: sessão ODBC caída
+    por timeout ou reinício do coordenador), para que a próxima query reconecte."""
+    local = _turbodbc_local()
+    conn = getattr(local, 'conn', None)
+    local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def normalizar_decimais(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converte colunas DECIMAL (que chegam como object com decimal.Decimal) para
+    float64. Colunas numéricas nativas são convertidas para Arrow sem cópia na
+    exibição e permitem operações vetorizadas; object exige conversão por valor.
+    """
+    for coluna in df.columns[df.dtypes == object].tolist():
+        valores = df[coluna].dropna()
+        # float em coluna object: chunk todo NULL concatenado com chunk já convertido
+        if not valores.empty and isinstance(valores.iloc[0], (Decimal, float)):
+            try:
+                df[coluna] = df[coluna].astype('float64')
+            except (TypeError, ValueError):
+                pass
+    return df
+
+def compactar_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduz colunas inteiras (contagens, códigos, períodos) para int32 quando os
+    valores cabem. Valores monetários permanecem float64 para não perder centavos.
+    """
+    limite = np.iinfo(np.int32)
+    for coluna in df.select_dtypes(include='int64').columns:
+        if df.empty or (df[coluna].min() >= limite.min and df[coluna].max() <= limite.max):
+            df[coluna] = df[coluna].astype(np.int32)
+    return df
+
+def ler_sql(query: str, engine) -> pd.DataFrame:
+    """
+    Lê o resultado da query. Com turbodbc configurado busca o resultado como
+    Arrow (sem materializar tuplas Python por linha); senão usa pd.read_sql.
+    """
+    conn = get_turbodbc_conn()
+    if conn is None:
+        # Lê em blocos: cada bloco de tuplas vira DataFrame (e tem os Decimal
+        # convertidos) antes do próximo, reduzindo o pico de memória.
+        blocos = [
+            normalizar_decimais(bloco)
+            for bloco in pd.read_sql(query, engine, chunksize=LEITURA_CHUNKSIZE)
+        ]
+        if not blocos:
+            return pd.DataFrame()
+        if len(blocos) == 1:
+            return blocos[0]
+        return normalizar_decimais(pd.concat(blocos, ignore_index=True))
+    # Uma nova tentativa com conexão nova: uma sessão morta nunca é reutilizada
+    for tentativa in range(2):
+        if tentativa:
+            conn = get_turbodbc_conn()
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            return normalizar_decimais(cursor.fetchallarrow().to_pandas())
+        except Exception:
+            descartar_turbodbc_conn()
+            if tentativa:
+                raise
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
 def executar_query(query: str) -> pd.DataFrame:
     """Executa query no Impala e retorna DataFrame."""
     engine = get_impala_engine()
     if engine is None:
         return pd.DataFrame()
     try:
-        return pd.read_sql(query, engine)
+        return ler_sql(query, engine)
     except Exception as e:
         st.error(f"Erro na query: {e}")
         return pd.DataFrame()
@@ -102,53 +218,177 @@ def executar_query_thread_safe(query: str) -> pd.DataFrame:
     if engine is None:
         return pd.DataFrame()
     try:
-        return pd.read_sql(query, engine)
+        return ler_sql(query, engine)
     except Exception as e:
         print(f"Erro na query: {e}")  # Log para debug
         return pd.DataFrame()
 
-@st.cache_data(ttl=600, show_spinner=False)
-def executar_query_cached(query: str, _cache_key: str = None) -> pd.DataFrame:
+# =============================================================================
+# CACHE EM DISCO (Parquet) - sobrevive a reinícios do Streamlit
+# =============================================================================
+CACHE_TTL_SEGUNDOS = 600
+CACHE_DISCO_DIR = Path(__file__).resolve().parent / '.cache_notas'
+
+def _caminho_cache_disco(query: str) -> Path:
+    """Retorna o arquivo Parquet correspondente ao SQL informado."""
+    chave = hashlib.sha256(query.encode('utf-8')).hexdigest()
+    return CACHE_DISCO_DIR / f"{chave}.parquet"
+
+def _ler_cache_disco(query: str) -> Optional[Tuple[pd.DataFrame, float]]:
+    """Lê resultado do cache em disco se existir e ainda estiver dentro do TTL.
+    Retorna (DataFrame, instante de gravação); arquivo vencido é removido."""
+    caminho = _caminho_cache_disco(query)
+    try:
+        gravado_em = caminho.stat().st_mtime
+        if time.time() - gravado_em < CACHE_TTL_SEGUNDOS:
+            return pd.read_parquet(caminho), gravado_em
+        caminho.unlink(missing_ok=True)
+    except Exception:
+        pass
+    return None
+
+def _remover_cache_disco_vencido():
+    """Apaga os arquivos do cache em disco fora do TTL (os resultados contêm dados
+    de contribuintes e não devem ficar no disco além do necessário)."""
+    limite = time.time() - CACHE_TTL_SEGUNDOS
+    for arquivo in CACHE_DISCO_DIR.glob('*.parquet'):
+        try:
+            if arquivo.stat().st_mtime < limite:
+                arquivo.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+def _gravar_cache_disco(query: str, df: pd.DataFrame):
+    """Grava resultado no cache em disco (falhas são apenas logadas)."""
+    caminho = _caminho_cache_disco(query)
+    temporario = caminho.with_suffix(f'.{threading.get_ident()}.tmp')
+    try:
+        CACHE_DISCO_DIR.mkdir(exist_ok=True)
+        df.to_parquet(temporario, index=False)
+        os.replace(temporario, caminho)
+    except Exception as e:
+        print(f"Erro ao gravar cache em disco: {e}")
+        temporario.unlink(missing_ok=True)
+    _remover_cache_disco_vencido()
+
+def limpar_cache_disco():
+    """Remove todos os resultados do cache em disco."""
+    for arquivo in CACHE_DISCO_DIR.glob('*.parquet'):
+        arquivo.unlink(missing_ok=True)
+
+@st.cache_data(ttl=CACHE_TTL_SEGUNDOS, show_spinner=False)
+def _executar_query_memoria(query: str) -> Tuple[pd.DataFrame, float]:
     """
-    Executa query no Impala COM CACHE de 10 minutos.
-    Use _cache_key para diferenciar queries com mesmo SQL mas contextos diferentes.
+    Camada em memória de executar_query_cached: (DataFrame, instante em que o
+    resultado foi obtido do Impala). Num acerto do disco o instante é o da gravação
+    do arquivo, e não o da leitura.
     """
+    lido = _ler_cache_disco(query)
+    if lido is not None:
+        return lido
     engine = get_impala_engine()
     if engine is None:
-        return pd.DataFrame()
+        return pd.DataFrame(), time.time()
     try:
-        return pd.read_sql(query, engine)
+        df = compactar_dtypes(ler_sql(query, engine))
     except Exception as e:
         print(f"Erro na query: {e}")
+        return pd.DataFrame(), time.time()
+    _gravar_cache_disco(query, df)
+    return df, time.time()
+
+def executar_query_cached(query: str, _cache_key: str = None) -> pd.DataFrame:
+    """
+    Executa query no Impala COM CACHE de 10 minutos (memória + Parquet em disco).
+    A chave efetiva do cache é o próprio SQL - o contexto (CNPJ, período, etc.)
+    precisa estar no texto da query. _cache_key serve apenas como identificação.
+    O TTL conta a partir da consulta ao Impala: um resultado vindo do disco perto
+    do vencimento não ganha mais 10 minutos na memória.
+    """
+    df, obtido_em = _executar_query_memoria(query)
+    if time.time() - obtido_em >= CACHE_TTL_SEGUNDOS:
+        _executar_query_memoria.clear(query)
+        df, _ = _executar_query_memoria(query)
+    return df
+
+@st.cache_resource
+def get_query_executor() -> ThreadPoolExecutor:
+    """Retorna pool de threads compartilhado pelo processo para execução de queries."""
+    return ThreadPoolExecutor(max_workers=QUERY_MAX_WORKERS, thread_name_prefix='notas_query')
+
+def submeter_queries(queries: Dict[str, str]) -> Dict[str, Future]:
+    """
+    Dispara várias queries em paralelo (com cache) e devolve {chave: futuro} sem esperar,
+    para que cada resultado seja consumido só quando for usado.
+    """
+    executor = get_query_executor()
+    return {chave: executor.submit(executar_query_cached, query) for chave, query in queries.items()}
+
+def resultado_ou_vazio(futuro: Future) -> pd.DataFrame:
+    """Resultado de um futuro de query; DataFrame vazio se a query falhou."""
+    try:
+        return futuro.result()
+    except Exception:
         return pd.DataFrame()
 
 # =============================================================================
 # FUNÇÕES AUXILIARES
 # =============================================================================
 
+_RE_NAO_DIGITO = re.compile(r'[^0-9]')
+
+# Tabela de remoção de tudo que não é dígito ASCII (Latin-1), usada com str.translate
+_TABELA_NAO_DIGITOS = str.maketrans('', '', ''.join(chr(c) for c in range(256) if not 48 <= c <= 57))
+
+def _somente_digitos(texto: str) -> str:
+    """Mantém apenas os dígitos de um texto (caminho rápido via str.translate)."""
+    limpo = texto.translate(_TABELA_NAO_DIGITOS)
+    if limpo.isascii():
+        return limpo
+    # Caracteres fora do Latin-1 sobreviveram à tabela: recorre ao regex
+    return _RE_NAO_DIGITO.sub('', limpo)
+
 def limpar_cnpj(cnpj: str) -> str:
     """Remove formatação do CNPJ."""
     if cnpj:
-        return re.sub(r'[^0-9]', '', str(cnpj))
+        return _somente_digitos(str(cnpj))
     return ""
 
 def limpar_ie(ie: str) -> str:
     """Remove formatação da Inscrição Estadual (pontos, hífens, etc.)."""
     if ie:
-        return re.sub(r'[^0-9]', '', str(ie))
+        return _somente_digitos(str(ie))
     return ""
 
+def limpar_cnpj_series(s: pd.Series) -> pd.Series:
+    """Remove formatação de uma Series de CNPJs de uma só vez (vetorizado)."""
+    return s.astype(str).where(s.notna(), '').str.replace(_RE_NAO_DIGITO, '', regex=True)
+
+@lru_cache(maxsize=200_000)
 def formatar_cnpj(cnpj: str) -> str:
-    """Formata CNPJ para exibição."""
-    cnpj = limpar_cnpj(cnpj)
+    """Formata CNPJ para exibição (memoizado: o mesmo CNPJ se repete em várias linhas)."""
+    # Caminho rápido: CNPJ já limpo (14 dígitos ASCII, o caso comum vindo do banco)
+    if not (type(cnpj) is str and len(cnpj) == 14 and cnpj.isascii() and cnpj.isdigit()):
+        cnpj = limpar_cnpj(cnpj)
     if len(cnpj) == 14:
         return f"{cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:14]}"
     return cnpj
 
+def formatar_cnpj_series(s: pd.Series) -> pd.Series:
+    """Formata uma Series de CNPJs (texto ou número, sem zeros à esquerda) de uma só vez.
+    Equivale a formatar_cnpj(str(x).zfill(14)) por linha; nulos viram ''."""
+    digitos = s.astype(str).str.zfill(14).str.replace(_RE_NAO_DIGITO, '', regex=True)
+    formatado = (digitos.str[:2] + '.' + digitos.str[2:5] + '.' + digitos.str[5:8] + '/'
+                 + digitos.str[8:12] + '-' + digitos.str[12:14])
+    return formatado.where(digitos.str.len() == 14, digitos).where(s.notna(), '')
+
+@lru_cache(maxsize=200_000)
 def formatar_ie(ie: str) -> str:
-    """Formata IE para exibição no formato XX.XXX.XXX-X."""
+    """Formata IE para exibição no formato XX.XXX.XXX-X (memoizado)."""
     if ie:
-        ie = limpar_ie(ie)
+        # Caminho rápido: IE já limpa (9 dígitos ASCII) dispensa a limpeza
+        if not (type(ie) is str and len(ie) == 9 and ie.isascii() and ie.isdigit()):
+            ie = limpar_ie(ie)
         if len(ie) == 9:
             return f"{ie[:2]}.{ie[2:5]}.{ie[5:8]}-{ie[8]}"
     return ie or "-"
@@ -157,7 +397,39 @@ def formatar_moeda(valor: float) -> str:
     """Formata valor como moeda brasileira."""
     if pd.isna(valor) or valor is None:
         return "R$ 0,00"
-    return f"R$ {valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    # Arredondar para centavos antes do cache para maximizar acertos; "+ 0.0" troca
+    # -0.0 por 0.0 (chaves iguais no lru_cache: a primeira a entrar decidiria o sinal)
+    return _formatar_moeda_centavos(round(float(valor), 2) + 0.0)
+
+# Troca "," <-> "." em uma única passada (1.234.567,89 a partir de 1,234,567.89).
+# Tabela de bytes: bytes.translate é um lookup direto em C, ~2x mais rápido
+# que str.translate (que consulta um dict por caractere).
+_TABELA_MOEDA_BR = bytes.maketrans(b',.', b'.,')
+
+def _moeda_br(valor: float) -> str:
+    """Formata float como 'R$ 1.234,56' (troca de separadores no nível de bytes)."""
+    return "R$ " + format(valor, ',.2f').encode('ascii').translate(_TABELA_MOEDA_BR).decode('ascii')
+
+@lru_cache(maxsize=200_000)
+def _formatar_moeda_centavos(valor: float) -> str:
+    """Formata valor (já arredondado em centavos) como moeda brasileira."""
+    return _moeda_br(valor)
+
+def limpar_cache_formatadores():
+    """Limpa os caches de memoização dos formatadores."""
+    formatar_cnpj.cache_clear()
+    formatar_ie.cache_clear()
+    _formatar_moeda_centavos.cache_clear()
+
+def truncar_texto_series(s: pd.Series, limite: int) -> pd.Series:
+    """Trunca textos com mais de `limite` caracteres, acrescentando '...' (versão vetorizada).
+    Valores que não são texto (None/NaN) ficam como estão."""
+    if not pd.api.types.is_object_dtype(s) and not pd.api.types.is_string_dtype(s):
+        return s
+    longos = s.str.len() > limite
+    if not longos.any():
+        return s
+    return s.where(~longos, s.str.slice(0, limite) + '...')
 
 def formatar_percentual(valor: float) -> str:
     """Formata valor como percentual."""
@@ -174,7 +446,11 @@ def formatar_numero(valor: float) -> str:
 # =============================================================================
 # CONFIGURAÇÕES DE COLUNAS PARA TABELAS (ordenação correta + formatação)
 # =============================================================================
+# As configs são memoizadas: o st.dataframe faz deepcopy de cada config antes
+# de alterá-la, então o mesmo objeto pode ser reaproveitado por todas as tabelas
+# renderizadas na execução do script.
 
+@lru_cache(maxsize=512)
 def col_moeda(label: str, help_text: str = None):
     """Coluna de valor monetário com formatação BR e ordenação correta."""
     return st.column_config.NumberColumn(
@@ -183,6 +459,7 @@ def col_moeda(label: str, help_text: str = None):
         format="R$ %.2f"
     )
 
+@lru_cache(maxsize=512)
 def col_numero(label: str, help_text: str = None):
     """Coluna numérica inteira com ordenação correta."""
     return st.column_config.NumberColumn(
@@ -191,6 +468,7 @@ def col_numero(label: str, help_text: str = None):
         format="%d"
     )
 
+@lru_cache(maxsize=512)
 def col_percentual(label: str, help_text: str = None):
     """Coluna de percentual com ordenação correta."""
     return st.column_config.NumberColumn(
@@ -199,6 +477,7 @@ def col_percentual(label: str, help_text: str = None):
         format="%.2f%%"
     )
 
+@lru_cache(maxsize=512)
 def col_barra_valor(label: str, max_value: float = None, help_text: str = None):
     """Coluna com barra de progresso colorida (verde=maior, vermelho=menor)."""
     return st.column_config.ProgressColumn(
@@ -209,6 +488,7 @@ def col_barra_valor(label: str, max_value: float = None, help_text: str = None):
         max_value=float(max_value) if max_value is not None else None
     )
 
+@lru_cache(maxsize=512)
 def col_barra_qtd(label: str, max_value: float = None, help_text: str = None):
     """Coluna com barra de progresso para quantidades."""
     return st.column_config.ProgressColumn(
@@ -219,6 +499,7 @@ def col_barra_qtd(label: str, max_value: float = None, help_text: str = None):
         max_value=float(max_value) if max_value is not None else None
     )
 
+@lru_cache(maxsize=512)
 def col_barra_pct(label: str, help_text: str = None):
     """Coluna com barra de progresso para percentuais (0-100)."""
     return st.column_config.ProgressColumn(
@@ -257,13 +538,60 @@ class NotasQueries:
     # Referência: https://impala.apache.org/docs/build/html/topics/impala_complex_types.html
     # =========================================================================
     
+    # Os get_* são funções puras dos argumentos e ficam memoizados com lru_cache
+    # durante a execução do script (o Streamlit recria a classe a cada rerun;
+    # entre reruns quem evita o trabalho é o cache de resultados).
+    
     @staticmethod
+    def _cnae_classe(cnae: str) -> str:
+        """CNAE no ARGOS usa 5 dígitos (classe), não 7 (subclasse)."""
+        return cnae[:5] if len(cnae) >= 5 else cnae
+    
+    @staticmethod
+    def _filtro_cnpj(coluna: str, cnpj: str, normalizar: bool = False) -> str:
+        """Filtro por CNPJ (já limpo, só dígitos).
+        Por padrão compara a coluna nativa com o literal de 14 dígitos (sargável: usa
+        as estatísticas min/max do Parquet). normalizar=True mantém a normalização
+        original (CAST/TRIM/REGEXP_REPLACE em cada linha), para as bases *_raw cujo
+        tipo/formato da coluna não é garantido."""
+        if normalizar:
+            return f"REGEXP_REPLACE(TRIM(CAST({coluna} AS STRING)), '[^0-9]', '') = '{cnpj}'"
+        return f"{coluna} = '{cnpj}'"
+    
+    @staticmethod
+    def _notas_validas(alias: str, periodo_inicio: int, periodo_fim: int, saida: bool = False) -> str:
+        """Filtros comuns a todas as consultas de NFe/NFCe: nota autorizada
+        (situacao = 1), finalidade normal (finnfe = 1) e período; com `saida`,
+        apenas notas de saída (tpnf = 1)."""
+        filtros = [f"{alias}.situacao = 1"]
+        if saida:
+            filtros.append(f"{alias}.procnfe.nfe.infnfe.ide.tpnf = 1")
+        filtros.append(f"{alias}.procnfe.nfe.infnfe.ide.finnfe = 1")
+        filtros.append(NotasQueries._periodo_predicate(alias, periodo_inicio, periodo_fim))
+        return " AND ".join(filtros)
+    
+    @staticmethod
+    def _periodo_predicate(alias: str, periodo_inicio: int, periodo_fim: int) -> str:
+        """Filtro AAAAMM decomposto em ano/mês.
+        Equivale a (ano * 100 + mes) BETWEEN inicio AND fim, mas compara as colunas
+        diretamente: o Impala consegue podar partições por ano_emissao e usar as
+        estatísticas min/max do Parquet, o que a expressão aritmética impede."""
+        ano_ini, mes_ini = divmod(int(periodo_inicio), 100)
+        ano_fim, mes_fim = divmod(int(periodo_fim), 100)
+        return (
+            f"({alias}.ano_emissao BETWEEN {ano_ini} AND {ano_fim}"
+            f" AND ({alias}.ano_emissao > {ano_ini} OR {alias}.mes_emissao >= {mes_ini})"
+            f" AND ({alias}.ano_emissao < {ano_fim} OR {alias}.mes_emissao <= {mes_fim}))"
+        )
+    
+    @staticmethod
+    @lru_cache(maxsize=256)
     def get_cadastro_query(ie: str = None, cnpj: str = None) -> str:
         """Query para dados cadastrais do contribuinte."""
         if ie:
             where_clause = f"TRIM(oc.nu_ie) = '{ie}'"
         else:
-            where_clause = f"REGEXP_REPLACE(TRIM(CAST(oc.nu_cnpj AS STRING)), '[^0-9]', '') = '{cnpj}'"
+            where_clause = NotasQueries._filtro_cnpj('oc.nu_cnpj', cnpj)
         
         return f"""
         SELECT
@@ -310,61 +638,58 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_nfe_emitidas_resumo(cnpj: str, periodo_inicio: int, periodo_fim: int) -> str:
         """Query para resumo de NFe emitidas por período - usando totais da nota."""
         return f"""
         SELECT
-            CONCAT(CAST(a.ano_emissao AS STRING), LPAD(CAST(a.mes_emissao AS STRING), 2, '0')) AS periodo,
+            (a.ano_emissao * 100 + a.mes_emissao) AS periodo,
             COUNT(DISTINCT a.chave) AS qtd_notas,
             SUM(COALESCE(a.procnfe.nfe.infnfe.total.icmstot.vnf, 0)) AS valor_total,
             COUNT(*) AS qtd_itens
         FROM nfe.nfe a
         WHERE a.procnfe.nfe.infnfe.emit.cnpj = '{cnpj}'
-          AND a.situacao = 1
-          AND a.procnfe.nfe.infnfe.ide.tpnf = 1
-          AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-          AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
-        GROUP BY CONCAT(CAST(a.ano_emissao AS STRING), LPAD(CAST(a.mes_emissao AS STRING), 2, '0'))
+          AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim, saida=True)}
+        GROUP BY a.ano_emissao * 100 + a.mes_emissao
         ORDER BY periodo
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_nfe_recebidas_resumo(cnpj: str, periodo_inicio: int, periodo_fim: int) -> str:
         """Query para resumo de NFe recebidas por período - usando totais da nota."""
         return f"""
         SELECT
-            CONCAT(CAST(a.ano_emissao AS STRING), LPAD(CAST(a.mes_emissao AS STRING), 2, '0')) AS periodo,
+            (a.ano_emissao * 100 + a.mes_emissao) AS periodo,
             COUNT(DISTINCT a.chave) AS qtd_notas,
             SUM(COALESCE(a.procnfe.nfe.infnfe.total.icmstot.vnf, 0)) AS valor_total,
             COUNT(*) AS qtd_itens
         FROM nfe.nfe a
         WHERE a.procnfe.nfe.infnfe.dest.cnpj = '{cnpj}'
-          AND a.situacao = 1
-          AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-          AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
-        GROUP BY CONCAT(CAST(a.ano_emissao AS STRING), LPAD(CAST(a.mes_emissao AS STRING), 2, '0'))
+          AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim)}
+        GROUP BY a.ano_emissao * 100 + a.mes_emissao
         ORDER BY periodo
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_nfce_resumo(cnpj: str, periodo_inicio: int, periodo_fim: int) -> str:
         """Query para resumo de NFCe por período - usando totais da nota."""
         return f"""
         SELECT
-            CONCAT(CAST(a.ano_emissao AS STRING), LPAD(CAST(a.mes_emissao AS STRING), 2, '0')) AS periodo,
+            (a.ano_emissao * 100 + a.mes_emissao) AS periodo,
             COUNT(DISTINCT a.chave) AS qtd_notas,
             SUM(COALESCE(a.procnfe.nfe.infnfe.total.icmstot.vnf, 0)) AS valor_total,
             COUNT(*) AS qtd_itens
         FROM nfce.nfce a
         WHERE a.procnfe.nfe.infnfe.emit.cnpj = '{cnpj}'
-          AND a.situacao = 1
-          AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-          AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
-        GROUP BY CONCAT(CAST(a.ano_emissao AS STRING), LPAD(CAST(a.mes_emissao AS STRING), 2, '0'))
+          AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim)}
+        GROUP BY a.ano_emissao * 100 + a.mes_emissao
         ORDER BY periodo
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_top_clientes(cnpj: str, periodo_inicio: int, periodo_fim: int, limit: int = 10) -> str:
         """Query para top clientes (NFe emitidas) - sem EXPLODE."""
         return f"""
@@ -377,10 +702,7 @@ class NotasQueries:
             COUNT(*) AS qtd_itens
         FROM nfe.nfe a
         WHERE a.procnfe.nfe.infnfe.emit.cnpj = '{cnpj}'
-          AND a.situacao = 1
-          AND a.procnfe.nfe.infnfe.ide.tpnf = 1
-          AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-          AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+          AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim, saida=True)}
           AND a.procnfe.nfe.infnfe.dest.cnpj IS NOT NULL
           AND TRIM(a.procnfe.nfe.infnfe.dest.cnpj) != ''
         GROUP BY 
@@ -392,6 +714,7 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_top_fornecedores(cnpj: str, periodo_inicio: int, periodo_fim: int, limit: int = 10) -> str:
         """Query para top fornecedores (NFe recebidas) - sem EXPLODE."""
         return f"""
@@ -404,9 +727,7 @@ class NotasQueries:
             COUNT(*) AS qtd_itens
         FROM nfe.nfe a
         WHERE a.procnfe.nfe.infnfe.dest.cnpj = '{cnpj}'
-          AND a.situacao = 1
-          AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-          AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+          AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim)}
         GROUP BY 
             a.procnfe.nfe.infnfe.emit.cnpj,
             a.procnfe.nfe.infnfe.emit.xnome,
@@ -416,10 +737,11 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_top_ncm_nfe(cnpj: str, periodo_inicio: int, periodo_fim: int, limit: int = 10) -> str:
         """Query para top NCM em NFe emitidas usando JOIN com array e tabela de descrição."""
         return f"""
-        SELECT 
+        SELECT STRAIGHT_JOIN
             n.ncm,
             COALESCE(t.descricao, 'Descrição não encontrada') AS descricao_ncm,
             n.qtd_notas,
@@ -436,24 +758,22 @@ class NotasQueries:
                 a.procnfe.nfe.infnfe.det det
             WHERE 
                 a.procnfe.nfe.infnfe.emit.cnpj = '{cnpj}'
-                AND a.situacao = 1
-                AND a.procnfe.nfe.infnfe.ide.tpnf = 1
-                AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-                AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+                AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim, saida=True)}
                 AND det.item.prod.ncm IS NOT NULL
             GROUP BY det.item.prod.ncm
             ORDER BY valor_total DESC
             LIMIT {limit}
         ) n
-        LEFT JOIN niat.tabela_ncm t ON n.ncm = t.ncm
+        LEFT JOIN /* +BROADCAST */ niat.tabela_ncm t ON n.ncm = t.ncm
         ORDER BY n.valor_total DESC
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_top_ncm_nfce(cnpj: str, periodo_inicio: int, periodo_fim: int, limit: int = 10) -> str:
         """Query para top NCM em NFCe usando JOIN com array e tabela de descrição."""
         return f"""
-        SELECT 
+        SELECT STRAIGHT_JOIN
             n.ncm,
             COALESCE(t.descricao, 'Descrição não encontrada') AS descricao_ncm,
             n.qtd_notas,
@@ -470,23 +790,22 @@ class NotasQueries:
                 a.procnfe.nfe.infnfe.det det
             WHERE 
                 a.procnfe.nfe.infnfe.emit.cnpj = '{cnpj}'
-                AND a.situacao = 1
-                AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-                AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+                AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim)}
                 AND det.item.prod.ncm IS NOT NULL
             GROUP BY det.item.prod.ncm
             ORDER BY valor_total DESC
             LIMIT {limit}
         ) n
-        LEFT JOIN niat.tabela_ncm t ON n.ncm = t.ncm
+        LEFT JOIN /* +BROADCAST */ niat.tabela_ncm t ON n.ncm = t.ncm
         ORDER BY n.valor_total DESC
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_cfop_nfe(cnpj: str, periodo_inicio: int, periodo_fim: int) -> str:
         """Query para distribuição por CFOP usando JOIN com array e tabela de descrição."""
         return f"""
-        SELECT 
+        SELECT STRAIGHT_JOIN
             c.cfop,
             COALESCE(t.descricaocfop, 'Descrição não encontrada') AS descricao_cfop,
             COALESCE(t.eous, '') AS entrada_saida,
@@ -508,18 +827,16 @@ class NotasQueries:
                 a.procnfe.nfe.infnfe.det det
             WHERE 
                 a.procnfe.nfe.infnfe.emit.cnpj = '{cnpj}'
-                AND a.situacao = 1
-                AND a.procnfe.nfe.infnfe.ide.tpnf = 1
-                AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-                AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+                AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim, saida=True)}
                 AND det.item.prod.cfop IS NOT NULL
             GROUP BY det.item.prod.cfop
         ) c
-        LEFT JOIN niat.tabela_cfop t ON CAST(c.cfop AS STRING) = CAST(t.cfop AS STRING)
+        LEFT JOIN /* +BROADCAST */ niat.tabela_cfop t ON CAST(c.cfop AS STRING) = CAST(t.cfop AS STRING)
         ORDER BY c.valor_total DESC
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_top_produtos_nfe(cnpj: str, periodo_inicio: int, periodo_fim: int, limit: int = 20) -> str:
         """Query para top produtos em NFe usando JOIN com array."""
         return f"""
@@ -536,10 +853,7 @@ class NotasQueries:
             a.procnfe.nfe.infnfe.det det
         WHERE 
             a.procnfe.nfe.infnfe.emit.cnpj = '{cnpj}'
-            AND a.situacao = 1
-            AND a.procnfe.nfe.infnfe.ide.tpnf = 1
-            AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-            AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+            AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim, saida=True)}
             AND det.item.prod.xprod IS NOT NULL
         GROUP BY 
             det.item.prod.xprod,
@@ -550,6 +864,7 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_top_produtos_nfce(cnpj: str, periodo_inicio: int, periodo_fim: int, limit: int = 20) -> str:
         """Query para top produtos em NFCe usando JOIN com array."""
         return f"""
@@ -566,9 +881,7 @@ class NotasQueries:
             a.procnfe.nfe.infnfe.det det
         WHERE 
             a.procnfe.nfe.infnfe.emit.cnpj = '{cnpj}'
-            AND a.situacao = 1
-            AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-            AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+            AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim)}
             AND det.item.prod.xprod IS NOT NULL
         GROUP BY 
             det.item.prod.xprod,
@@ -579,10 +892,11 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_top_ncm_entrada(cnpj: str, periodo_inicio: int, periodo_fim: int, limit: int = 10) -> str:
         """Query para top NCM em NFe RECEBIDAS (entradas) usando JOIN com array."""
         return f"""
-        SELECT 
+        SELECT STRAIGHT_JOIN
             n.ncm,
             COALESCE(t.descricao, 'Descrição não encontrada') AS descricao_ncm,
             n.qtd_notas,
@@ -599,23 +913,22 @@ class NotasQueries:
                 a.procnfe.nfe.infnfe.det det
             WHERE 
                 a.procnfe.nfe.infnfe.dest.cnpj = '{cnpj}'
-                AND a.situacao = 1
-                AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-                AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+                AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim)}
                 AND det.item.prod.ncm IS NOT NULL
             GROUP BY det.item.prod.ncm
             ORDER BY valor_total DESC
             LIMIT {limit}
         ) n
-        LEFT JOIN niat.tabela_ncm t ON n.ncm = t.ncm
+        LEFT JOIN /* +BROADCAST */ niat.tabela_ncm t ON n.ncm = t.ncm
         ORDER BY n.valor_total DESC
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_cfop_entrada(cnpj: str, periodo_inicio: int, periodo_fim: int) -> str:
         """Query para distribuição por CFOP em NFe RECEBIDAS (entradas)."""
         return f"""
-        SELECT 
+        SELECT STRAIGHT_JOIN
             c.cfop,
             COALESCE(t.descricaocfop, 'Descrição não encontrada') AS descricao_cfop,
             COALESCE(t.eous, '') AS entrada_saida,
@@ -637,17 +950,16 @@ class NotasQueries:
                 a.procnfe.nfe.infnfe.det det
             WHERE 
                 a.procnfe.nfe.infnfe.dest.cnpj = '{cnpj}'
-                AND a.situacao = 1
-                AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-                AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+                AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim)}
                 AND det.item.prod.cfop IS NOT NULL
             GROUP BY det.item.prod.cfop
         ) c
-        LEFT JOIN niat.tabela_cfop t ON CAST(c.cfop AS STRING) = CAST(t.cfop AS STRING)
+        LEFT JOIN /* +BROADCAST */ niat.tabela_cfop t ON CAST(c.cfop AS STRING) = CAST(t.cfop AS STRING)
         ORDER BY c.valor_total DESC
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_faturamento_dime(cnpj: str, periodo_inicio: int, periodo_fim: int) -> str:
         """Query para faturamento DIME (regime normal)."""
         return f"""
@@ -659,12 +971,13 @@ class NotasQueries:
             COALESCE(CAST(VL_TOT_DEB AS DOUBLE), 0) AS total_debitos,
             COALESCE(CAST(VL_DEB_RECOLHER AS DOUBLE), 0) AS debito_recolher
         FROM usr_sat_ods.ods_decl_dime_raw
-        WHERE REGEXP_REPLACE(TRIM(CAST(NU_CNPJ AS STRING)), '[^0-9]', '') = '{cnpj}'
+        WHERE {NotasQueries._filtro_cnpj('NU_CNPJ', cnpj, normalizar=True)}
           AND CAST(nu_per_ref AS INT) BETWEEN {periodo_inicio} AND {periodo_fim}
         ORDER BY nu_per_ref
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_faturamento_pgdas(cnpj: str, periodo_inicio: int, periodo_fim: int) -> str:
         """Query para faturamento PGDAS (Simples Nacional)."""
         return f"""
@@ -672,19 +985,21 @@ class NotasQueries:
             CAST(nu_per_ref AS INT) AS periodo,
             COALESCE(CAST(vl_rec_bruta_estab AS DOUBLE), 0) AS receita_bruta
         FROM usr_sat_ods.sna_pgdasd_estabelecimento_raw
-        WHERE REGEXP_REPLACE(TRIM(CAST(nu_cnpj AS STRING)), '[^0-9]', '') = '{cnpj}'
+        WHERE {NotasQueries._filtro_cnpj('nu_cnpj', cnpj, normalizar=True)}
           AND CAST(nu_per_ref AS INT) BETWEEN {periodo_inicio} AND {periodo_fim}
         ORDER BY nu_per_ref
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_setor_stats(cnae: str, periodo_inicio: int, periodo_fim: int) -> str:
-        """Query para estatísticas do setor (empresas do mesmo CNAE) - usando totais da nota."""
+        """Query para estatísticas do setor (empresas do mesmo CNAE) - usando totais da nota.
+        Todas as medidas saem de uma única agregação sobre vendas_setor; apenas
+        mediana_faturamento é aproximada (APPX_MEDIAN), as demais são exatas."""
         return f"""
         WITH empresas_setor AS (
             SELECT DISTINCT 
-                oc.nu_cnpj AS cnpj,
-                oc.nm_razao_social AS razao_social
+                oc.nu_cnpj AS cnpj
             FROM usr_sat_ods.vw_ods_contrib oc
             WHERE LPAD(CAST(oc.cd_cnae AS STRING), 7, '0') = '{cnae}'
               AND oc.nm_sit_cadastral = 'ATIVO'
@@ -696,11 +1011,10 @@ class NotasQueries:
                 SUM(COALESCE(a.procnfe.nfe.infnfe.total.icmstot.vnf, 0)) AS valor_total,
                 COUNT(DISTINCT a.chave) AS qtd_notas
             FROM nfe.nfe a
-            INNER JOIN empresas_setor e ON a.procnfe.nfe.infnfe.emit.cnpj = e.cnpj
-            WHERE a.situacao = 1
-              AND a.procnfe.nfe.infnfe.ide.tpnf = 1
-              AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-              AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+            -- Semi-join com broadcast: empresas_setor (milhares de linhas) é
+            -- replicada em cada nó e nfe.nfe é filtrada localmente, sem shuffle
+            LEFT SEMI JOIN /* +BROADCAST */ empresas_setor e ON a.procnfe.nfe.infnfe.emit.cnpj = e.cnpj
+            WHERE {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim, saida=True)}
             GROUP BY a.procnfe.nfe.infnfe.emit.cnpj
         )
         SELECT
@@ -716,6 +1030,7 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_tributacao_nfe(cnpj: str, periodo_inicio: int, periodo_fim: int) -> str:
         """Query para análise de tributação usando JOIN com array."""
         return f"""
@@ -736,10 +1051,7 @@ class NotasQueries:
             a.procnfe.nfe.infnfe.det det
         WHERE 
             a.procnfe.nfe.infnfe.emit.cnpj = '{cnpj}'
-            AND a.situacao = 1
-            AND a.procnfe.nfe.infnfe.ide.tpnf = 1
-            AND a.procnfe.nfe.infnfe.ide.finnfe = 1
-            AND (a.ano_emissao * 100 + a.mes_emissao) BETWEEN {periodo_inicio} AND {periodo_fim}
+            AND {NotasQueries._notas_validas('a', periodo_inicio, periodo_fim, saida=True)}
         GROUP BY 
             COALESCE(det.item.imposto.icms.resumo.cst, 
                      CAST(det.item.imposto.icms.resumo.csosn AS STRING)),
@@ -749,6 +1061,7 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_ttd_empresa(ie: str) -> str:
         """Query para TTDs ativos da empresa."""
         return f"""
@@ -770,6 +1083,7 @@ class NotasQueries:
     # =========================================================================
     
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_periodo_mais_recente_argos() -> str:
         """Query para buscar período mais recente disponível no ARGOS."""
         return """
@@ -778,11 +1092,11 @@ class NotasQueries:
         """
     
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_benchmark_setorial(cnae_classe: str, periodo: int) -> str:
         """Query para benchmark do setor no período.
         CNAE no ARGOS usa 5 dígitos (classe), não 7 (subclasse)."""
-        # Pegar apenas os 5 primeiros dígitos do CNAE
-        cnae_5dig = cnae_classe[:5] if len(cnae_classe) >= 5 else cnae_classe
+        cnae_5dig = NotasQueries._cnae_classe(cnae_classe)
         return f"""
         SELECT 
             cnae_classe,
@@ -803,6 +1117,7 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_empresa_vs_benchmark(cnpj: str, periodo: int) -> str:
         """Query para comparação da empresa vs benchmark do setor."""
         return f"""
@@ -831,10 +1146,11 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_empresas_setor(cnae_classe: str, periodo: int, limit: int = 50) -> str:
         """Query para listar empresas do mesmo setor.
         CNAE no ARGOS usa 5 dígitos (classe)."""
-        cnae_5dig = cnae_classe[:5] if len(cnae_classe) >= 5 else cnae_classe
+        cnae_5dig = NotasQueries._cnae_classe(cnae_classe)
         return f"""
         SELECT 
             nu_cnpj,
@@ -842,7 +1158,7 @@ class NotasQueries:
             porte_empresa,
             vl_faturamento,
             icms_devido,
-            aliq_efetiva_empresa,
+            aliq_efetiva_empresa * 100 AS aliq_pct,
             indice_vs_mediana_setor,
             status_vs_setor
         FROM niat.argos_empresa_vs_benchmark
@@ -854,6 +1170,7 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_alertas_empresa(cnpj: str, periodo: int = None) -> str:
         """Query para alertas da empresa."""
         periodo_cond = f"AND nu_per_ref = {periodo}" if periodo else ""
@@ -874,10 +1191,11 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_alertas_setor(cnae_classe: str, periodo: int, limit: int = 20) -> str:
         """Query para alertas das empresas do setor.
         CNAE no ARGOS usa 5 dígitos (classe)."""
-        cnae_5dig = cnae_classe[:5] if len(cnae_classe) >= 5 else cnae_classe
+        cnae_5dig = NotasQueries._cnae_classe(cnae_classe)
         return f"""
         SELECT 
             nu_cnpj,
@@ -895,10 +1213,11 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_evolucao_setor(cnae_classe: str) -> str:
         """Query para evolução temporal do setor.
         CNAE no ARGOS usa 5 dígitos (classe)."""
-        cnae_5dig = cnae_classe[:5] if len(cnae_classe) >= 5 else cnae_classe
+        cnae_5dig = NotasQueries._cnae_classe(cnae_classe)
         return f"""
         SELECT 
             nu_per_ref,
@@ -913,10 +1232,11 @@ class NotasQueries:
         """
 
     @staticmethod
+    @lru_cache(maxsize=256)
     def get_benchmark_por_porte(cnae_classe: str, periodo: int) -> str:
         """Query para benchmark segmentado por porte empresarial.
         CNAE no ARGOS usa 5 dígitos (classe)."""
-        cnae_5dig = cnae_classe[:5] if len(cnae_classe) >= 5 else cnae_classe
+        cnae_5dig = NotasQueries._cnae_classe(cnae_classe)
         return f"""
         SELECT 
             porte_empresa,
@@ -947,45 +1267,70 @@ class NotasQueries:
 # FUNÇÕES DE ANÁLISE
 # =============================================================================
 
-def calcular_indice_concentracao(valores: List[float]) -> Dict[str, float]:
-    """Calcula índices de concentração (Herfindahl e CR3/CR5)."""
-    if not valores or sum(valores) == 0:
+def calcular_indice_concentracao(valores: Union[List[float], np.ndarray]) -> Dict[str, float]:
+    """Calcula índices de concentração (Herfindahl e CR3/CR5).
+    Aceita lista ou array; um ndarray float64 é usado sem cópia."""
+    a = np.asarray(valores, dtype=np.float64)
+    total = float(a.sum())  # única redução; vazio soma 0.0
+    if total == 0:
         return {'hhi': 0, 'cr3': 0, 'cr5': 0}
+    if a.size == 1:
+        # Monopólio: participação única de 100%
+        return {'hhi': 10000.0, 'cr3': 100.0, 'cr5': 100.0}
     
-    total = sum(valores)
-    participacoes = [v / total for v in valores]
-    participacoes_sorted = sorted(participacoes, reverse=True)
+    participacoes = a / total
     
-    # Índice Herfindahl-Hirschman (HHI)
-    hhi = sum([p ** 2 for p in participacoes]) * 10000
+    # Índice Herfindahl-Hirschman (HHI): soma dos quadrados via produto escalar
+    hhi = float(participacoes @ participacoes) * 10000
     
-    # Concentração dos 3 e 5 maiores
-    cr3 = sum(participacoes_sorted[:3]) * 100 if len(participacoes_sorted) >= 3 else sum(participacoes_sorted) * 100
-    cr5 = sum(participacoes_sorted[:5]) * 100 if len(participacoes_sorted) >= 5 else sum(participacoes_sorted) * 100
+    # Concentração dos 3 e 5 maiores: np.partition separa os 5 maiores em O(n)
+    # e só essa cauda é ordenada
+    k = min(5, participacoes.size)
+    maiores = np.sort(np.partition(participacoes, participacoes.size - k)[-k:])[::-1]
+    cr3 = float(maiores[:3].sum()) * 100
+    cr5 = float(maiores.sum()) * 100
     
     return {'hhi': hhi, 'cr3': cr3, 'cr5': cr5}
 
 def identificar_outliers(df: pd.DataFrame, coluna: str, metodo: str = 'iqr') -> pd.DataFrame:
-    """Identifica outliers usando IQR ou Z-score."""
+    """Identifica outliers usando IQR ou Z-score.
+    Retorna um novo DataFrame via assign (sem df.copy(); com copy-on-write as colunas originais são compartilhadas)."""
     if df.empty or coluna not in df.columns:
         return df
     
-    df_copy = df.copy()
+    valores = df[coluna].to_numpy(dtype=np.float64, na_value=np.nan)
+    # Variantes nan* (mais lentas) só quando há nulos; pandas também os ignora
+    tem_nulos = bool(np.isnan(valores).any())
     
     if metodo == 'iqr':
-        Q1 = df_copy[coluna].quantile(0.25)
-        Q3 = df_copy[coluna].quantile(0.75)
+        # Uma única seleção para os dois quartis (interpolação linear, como o pandas)
+        quantil = np.nanquantile if tem_nulos else np.quantile
+        Q1, Q3 = quantil(valores, [0.25, 0.75])
         IQR = Q3 - Q1
-        limite_inferior = Q1 - 1.5 * IQR
-        limite_superior = Q3 + 1.5 * IQR
-        df_copy['outlier'] = (df_copy[coluna] < limite_inferior) | (df_copy[coluna] > limite_superior)
-    else:  # z-score
-        media = df_copy[coluna].mean()
-        desvio = df_copy[coluna].std()
-        df_copy['z_score'] = (df_copy[coluna] - media) / desvio if desvio > 0 else 0
-        df_copy['outlier'] = abs(df_copy['z_score']) > 3
-    
-    return df_copy
+        limite_inferior = float(Q1 - 1.5 * IQR)
+        limite_superior = float(Q3 + 1.5 * IQR)
+        return df.assign(outlier=(valores < limite_inferior) | (valores > limite_superior))
+    
+    # z-score: calculado uma vez sobre o ndarray e reutilizado na máscara
+    if tem_nulos:
+        media = np.nanmean(valores)
+        desvio = np.nanstd(valores, ddof=1)
+    else:
+        media = valores.mean()
+        desvio = valores.std(ddof=1)
+    z_score = (valores - media) / desvio if desvio > 0 else np.zeros_like(valores)
+    return df.assign(z_score=z_score, outlier=np.abs(z_score) > 3)
+
+def somar_por(df: pd.DataFrame, chave: str, colunas: List[str]) -> pd.DataFrame:
+    """Soma `colunas` agrupando por `chave` (kernel cython do groupby, sem dispatch por coluna)."""
+    return df.groupby(chave)[colunas].sum().reset_index()
+
+def percentual_seguro(numerador: pd.Series, denominador: pd.Series) -> np.ndarray:
+    """numerador / denominador * 100 onde denominador > 0, senão 0.
+    A divisão só é executada nas posições válidas (ufunc com where=)."""
+    num = numerador.to_numpy(dtype=np.float64)
+    den = denominador.to_numpy(dtype=np.float64)
+    return np.divide(num, den, out=np.zeros(len(den)), where=den > 0) * 100
 
 def calcular_variacao(atual: float, anterior: float) -> Tuple[float, str]:
     """Calcula variação percentual e tendência."""
@@ -1005,79 +1350,116 @@ def calcular_variacao(atual: float, anterior: float) -> Tuple[float, str]:
     
     return variacao, tendencia
 
+# Faixas de CFOP pelo milhar (searchsorted com side='right'): 0 = abaixo de 1000,
+# 1..6 = 1XXX..6XXX e 7 = 7000 em diante. Cada classificação é uma tupla de 8 rótulos.
+_LIMITES_FAIXA_CFOP = np.array([1000, 2000, 3000, 4000, 5000, 6000, 7000], dtype=np.float64)
+_CFOP_TIPOS_ENTRADA = ("Outros", "Interna (1XXX)", "Interestadual (2XXX)", "Exterior (3XXX)",
+                       "Outros", "Outros", "Outros", "Outros")
+_CFOP_TIPOS_SAIDA = ("Outros", "Outros", "Outros", "Outros", "Outros",
+                     "Interna (5XXX)", "Interestadual (6XXX)", "Exterior (7XXX)")
+_CFOP_TIPOS_SAIDA_SIMPLES = ("Outros", "Outros", "Outros", "Outros", "Outros",
+                             "Saída Interna", "Saída Interestadual", "Saída Exterior")
+
+def classificar_cfops(cfops: pd.Series, rotulos: Tuple[str, ...]) -> np.ndarray:
+    """Classifica uma coluna de CFOPs pela faixa do milhar (vetorizado, sem apply por linha).
+    CFOPs não numéricos ou nulos caem na faixa 0 ("Outros")."""
+    codigo = pd.to_numeric(cfops, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    faixa = np.where(np.isfinite(codigo), np.searchsorted(_LIMITES_FAIXA_CFOP, codigo, side='right'), 0)
+    return np.asarray(rotulos, dtype=object)[faixa]
+
+def resumir_cfops_por_tipo(df_cfop: pd.DataFrame, rotulos: Tuple[str, ...]) -> pd.DataFrame:
+    """Soma valor_total/qtd_notas por tipo de operação (classificar_cfops), do maior valor ao menor."""
+    if df_cfop.empty:
+        return pd.DataFrame()
+    df_tipo = df_cfop.assign(tipo=classificar_cfops(df_cfop['cfop'], rotulos))
+    return somar_por(df_tipo, 'tipo', ['valor_total', 'qtd_notas']).sort_values('valor_total', ascending=False)
+
+def somar_valor_por_tipo_cfop(df_cfop: pd.DataFrame, rotulos: Tuple[str, ...]) -> pd.Series:
+    """valor_total somado por tipo de operação (classificar_cfops), indexado pelo rótulo."""
+    if df_cfop.empty:
+        return pd.Series(dtype=np.float64)
+    return df_cfop['valor_total'].groupby(classificar_cfops(df_cfop['cfop'], rotulos)).sum()
+
 
 # =============================================================================
 # FUNÇÕES DE RENDERIZAÇÃO
 # =============================================================================
 
+# Default compartilhado de dados.get(...): os renders só testam .empty e nunca
+# alteram o frame ausente, então uma única instância basta
+_DF_VAZIO = pd.DataFrame()
+
+_COR_SITUACAO: Dict[str, str] = {
+    'ATIVA': "#28a745",            # Verde
+    'CANCELADA': "#dc3545",        # Vermelho
+    'BAIXA REQUERIDA': "#dc3545",  # Vermelho
+    'BAIXA DEFERIDA': "#ffc107",   # Amarelo
+}
+
 def obter_cor_situacao_cadastral(situacao: str) -> str:
-    """Retorna a cor de fundo baseada na situação cadastral."""
-    situacao_upper = situacao.upper() if situacao else ''
-    if situacao_upper == 'ATIVA':
-        return "#28a745"  # Verde
-    elif situacao_upper in ('CANCELADA', 'BAIXA REQUERIDA'):
-        return "#dc3545"  # Vermelho
-    elif situacao_upper == 'BAIXA DEFERIDA':
-        return "#ffc107"  # Amarelo
-    else:
-        return "#6c757d"  # Cinza (normal)
+    """Retorna a cor de fundo baseada na situação cadastral (cinza quando não mapeada)."""
+    return _COR_SITUACAO.get(situacao.upper() if situacao else '', "#6c757d")
 
-def render_header(cadastro: Dict):
-    """Renderiza cabeçalho com dados da empresa."""
-    situacao = cadastro.get('situacao_cadastral_desc', 'N/A')
+@st.cache_data(show_spinner=False, max_entries=64)
+def _build_header_html(campos: Tuple) -> str:
+    """Monta o HTML do cabeçalho; função pura, cacheada pelos campos exibidos."""
+    razao_social, cnpj, inscricao_estadual, situacao, cnae, cnae_desc, regime, municipio, uf = campos
     cor_situacao = obter_cor_situacao_cadastral(situacao)
-    cnae_desc = cadastro.get('descricao_cnae', 'N/A') or 'N/A'
     cnae_desc_curto = cnae_desc[:40] + '...' if len(cnae_desc) > 40 else cnae_desc
 
-    st.markdown(f"""
+    return f"""
     <div style='background: linear-gradient(135deg, #1e3c72 0%, #2a5298 100%);
                 padding: 10px 15px; border-radius: 8px; margin-bottom: 10px; color: white;'>
-        <h3 style='margin: 0 0 5px 0; font-size: 1.2em;'>📄 {cadastro.get('razao_social', 'N/A')}</h3>
+        <h3 style='margin: 0 0 5px 0; font-size: 1.2em;'>📄 {razao_social}</h3>
         <p style='margin: 2px 0; opacity: 0.9; font-size: 0.9em;'>
-            <strong>CNPJ:</strong> {formatar_cnpj(cadastro.get('cnpj', ''))} |
-            <strong>IE:</strong> {formatar_ie(cadastro.get('inscricao_estadual', ''))} |
+            <strong>CNPJ:</strong> {formatar_cnpj(cnpj)} |
+            <strong>IE:</strong> {formatar_ie(inscricao_estadual)} |
             <span style='background-color: {cor_situacao}; padding: 1px 6px; border-radius: 3px;'>{situacao}</span>
         </p>
         <p style='margin: 2px 0; opacity: 0.8; font-size: 0.85em;'>
-            <strong>CNAE:</strong> {cadastro.get('cnae', 'N/A')} - {cnae_desc_curto} |
-            <strong>Regime:</strong> {cadastro.get('regime_apuracao_desc', 'N/A')} |
-            <strong>Município:</strong> {cadastro.get('municipio', 'N/A')}/{cadastro.get('uf', 'SC')}
+            <strong>CNAE:</strong> {cnae} - {cnae_desc_curto} |
+            <strong>Regime:</strong> {regime} |
+            <strong>Município:</strong> {municipio}/{uf}
         </p>
     </div>
-    """, unsafe_allow_html=True)
+    """
 
+def render_header(cadastro: Dict):
+    """Renderiza cabeçalho com dados da empresa."""
+    campos = (
+        cadastro.get('razao_social', 'N/A'),
+        cadastro.get('cnpj', ''),
+        cadastro.get('inscricao_estadual', ''),
+        cadastro.get('situacao_cadastral_desc', 'N/A'),
+        cadastro.get('cnae', 'N/A'),
+        cadastro.get('descricao_cnae', 'N/A') or 'N/A',
+        cadastro.get('regime_apuracao_desc', 'N/A'),
+        cadastro.get('municipio', 'N/A'),
+        cadastro.get('uf', 'SC'),
+    )
+    st.markdown(_build_header_html(campos), unsafe_allow_html=True)
+
+
+def _kpi_cards(metricas: Dict) -> List[Tuple[str, str, Optional[str]]]:
+    """(label, valor, delta) já formatados dos quatro cards de KPI."""
+    emitidas_qtd = metricas.get('nfe_emitidas_qtd', 0)
+    emitidas_valor = metricas.get('nfe_emitidas_valor', 0)
+    # Ticket médio: quantidade zero (ou ausente) divide por 1
+    ticket_medio = emitidas_valor / (metricas.get('nfe_emitidas_qtd', 1) or 1)
+    return [
+        ("📤 NFe Emitidas", formatar_numero(emitidas_qtd), formatar_moeda(emitidas_valor)),
+        ("📥 NFe Recebidas", formatar_numero(metricas.get('nfe_recebidas_qtd', 0)),
+         formatar_moeda(metricas.get('nfe_recebidas_valor', 0))),
+        ("🛒 NFCe (Varejo)", formatar_numero(metricas.get('nfce_qtd', 0)),
+         formatar_moeda(metricas.get('nfce_valor', 0))),
+        ("💰 Ticket Médio NFe", formatar_moeda(ticket_medio), None),
+    ]
 
 def render_kpi_cards(metricas: Dict):
     """Renderiza cards de KPIs."""
-    cols = st.columns(4)
-    
-    with cols[0]:
-        st.metric(
-            label="📤 NFe Emitidas",
-            value=formatar_numero(metricas.get('nfe_emitidas_qtd', 0)),
-            delta=formatar_moeda(metricas.get('nfe_emitidas_valor', 0))
-        )
-    
-    with cols[1]:
-        st.metric(
-            label="📥 NFe Recebidas",
-            value=formatar_numero(metricas.get('nfe_recebidas_qtd', 0)),
-            delta=formatar_moeda(metricas.get('nfe_recebidas_valor', 0))
-        )
-    
-    with cols[2]:
-        st.metric(
-            label="🛒 NFCe (Varejo)",
-            value=formatar_numero(metricas.get('nfce_qtd', 0)),
-            delta=formatar_moeda(metricas.get('nfce_valor', 0))
-        )
-    
-    with cols[3]:
-        ticket_medio = metricas.get('nfe_emitidas_valor', 0) / max(metricas.get('nfe_emitidas_qtd', 1), 1)
-        st.metric(
-            label="💰 Ticket Médio NFe",
-            value=formatar_moeda(ticket_medio)
-        )
+    for col, (label, valor, delta) in zip(st.columns(4), _kpi_cards(metricas)):
+        with col:
+            st.metric(label=label, value=valor, delta=delta)
 
 
 def render_tab_cadastro(cadastro: Dict):
@@ -1098,13 +1480,14 @@ def render_tab_cadastro(cadastro: Dict):
             ("Data Início ICMS", str(cadastro.get('data_inicio_icms', '-'))),
         ]
 
-        for label, valor in dados:
-            st.markdown(f"**{label}:** {valor}")
-
-        # Situação cadastral com cor de fundo
+        # Situação cadastral com cor de fundo, no mesmo bloco de markdown. O bloco é
+        # renderizado com unsafe_allow_html, então os valores vindos do banco são
+        # escapados para não serem interpretados como HTML.
         situacao = cadastro.get('situacao_cadastral_desc', '-')
         cor_situacao = obter_cor_situacao_cadastral(situacao)
-        st.markdown(f"**Situação Cadastral:** <span style='background-color: {cor_situacao}; color: white; padding: 2px 8px; border-radius: 3px;'>{situacao}</span>", unsafe_allow_html=True)
+        linhas = [f"**{label}:** {html.escape(str(valor))}" for label, valor in dados]
+        linhas.append(f"**Situação Cadastral:** <span style='background-color: {cor_situacao}; color: white; padding: 2px 8px; border-radius: 3px;'>{html.escape(str(situacao))}</span>")
+        st.markdown("  \n".join(linhas), unsafe_allow_html=True)
     
     with col2:
         st.markdown("### 📍 Localização e Contato")
@@ -1122,8 +1505,8 @@ def render_tab_cadastro(cadastro: Dict):
             ("GERFE", cadastro.get('gerfe', '-') or '-'),
         ]
         
-        for label, valor in dados:
-            st.markdown(f"**{label}:** {valor}")
+        # Um único elemento por quadro (quebra de linha markdown entre os pares)
+        st.markdown("  \n".join(f"**{label}:** {valor}" for label, valor in dados))
     
     st.markdown("---")
     
@@ -1141,8 +1524,7 @@ def render_tab_cadastro(cadastro: Dict):
             ("Simples Nacional", "Sim" if cadastro.get('flag_simples_nacional') == 'S' else "Não"),
         ]
         
-        for label, valor in dados:
-            st.markdown(f"**{label}:** {valor}")
+        st.markdown("  \n".join(f"**{label}:** {valor}" for label, valor in dados))
     
     with col2:
         st.markdown("### 📊 Contabilista")
@@ -1155,8 +1537,54 @@ def render_tab_cadastro(cadastro: Dict):
             ("Sócios Ativos", cadastro.get('qtd_socios_ativos', '-')),
         ]
         
-        for label, valor in dados:
-            st.markdown(f"**{label}:** {valor}")
+        st.markdown("  \n".join(f"**{label}:** {valor}" for label, valor in dados))
+
+
+def _fig_barra_periodo(periodos, valores, nome: str, titulo: str, cor: str,
+                       eixo_categoria: bool = True) -> dict:
+    """Figura de barras por período como dict literal do Plotly.
+    Sem go.Figure/add_trace/update_layout: a única validação é a do st.plotly_chart."""
+    xaxis = {'title': {'text': 'Período'}}
+    if eixo_categoria:
+        xaxis['type'] = 'category'
+    return {
+        'data': [{'type': 'bar', 'x': list(periodos), 'y': list(valores),
+                  'name': nome, 'marker': {'color': cor}}],
+        'layout': {'title': {'text': titulo}, 'xaxis': xaxis,
+                   'yaxis': {'title': {'text': 'Valor (R$)'}}, 'height': 350},
+    }
+
+def _fig_nfce_periodo(periodos, valores, quantidades) -> dict:
+    """Figura NFCe (valor em barras + quantidade em linha) como dict literal do Plotly."""
+    return {
+        'data': [
+            {'type': 'bar', 'x': list(periodos), 'y': list(valores),
+             'name': 'Valor NFCe', 'marker': {'color': '#28a745'}},
+            {'type': 'scatter', 'x': list(periodos), 'y': list(quantidades),
+             'name': 'Qtd. Notas', 'yaxis': 'y2', 'line': {'color': '#dc3545', 'width': 2}},
+        ],
+        'layout': {
+            'title': {'text': 'NFCe - Valor e Quantidade por Período'},
+            'xaxis': {'title': {'text': 'Período'}, 'type': 'category'},
+            'yaxis': {'title': {'text': 'Valor (R$)'}, 'side': 'left'},
+            'yaxis2': {'title': {'text': 'Quantidade'}, 'side': 'right', 'overlaying': 'y'},
+            'height': 350,
+            'legend': {'x': 0, 'y': 1.15, 'orientation': 'h'},
+        },
+    }
+
+def _fig_barra_categorias(categorias, valores, paleta: List[str], titulo: str,
+                          titulo_x: str, titulo_y: str) -> dict:
+    """Barras com uma cor por categoria (paleta em ciclo, na ordem de aparição) como
+    dict literal do Plotly; equivale ao px.bar(color=x) sem legenda, sem o px copiar o DataFrame."""
+    codigos, _ = pd.factorize(pd.Series(categorias))
+    return {
+        'data': [{'type': 'bar', 'x': list(categorias), 'y': list(valores),
+                  'marker': {'color': [paleta[c % len(paleta)] for c in codigos]},
+                  'hovertemplate': f'{titulo_x}=%{{x}}<br>{titulo_y}=%{{y}}<extra></extra>'}],
+        'layout': {'title': {'text': titulo}, 'xaxis': {'title': {'text': titulo_x}},
+                   'yaxis': {'title': {'text': titulo_y}}, 'showlegend': False, 'height': 350},
+    }
 
 
 def render_tab_visao_geral(dados: Dict, periodo_inicio: int, periodo_fim: int):
@@ -1168,90 +1596,45 @@ def render_tab_visao_geral(dados: Dict, periodo_inicio: int, periodo_fim: int):
     
     st.markdown("---")
     
-    # Gráfico de evolução temporal
+    # Gráfico de evolução temporal. Os resumos chegam ordenados por periodo
+    # (inteiro AAAAMM, ORDER BY periodo no SQL): não é preciso reordenar aqui.
     st.markdown("### 📈 Evolução Mensal")
     
     col1, col2 = st.columns(2)
     
     with col1:
-        df_nfe_emit = dados.get('nfe_emitidas_resumo', pd.DataFrame())
+        df_nfe_emit = dados.get('nfe_emitidas_resumo', _DF_VAZIO)
         if not df_nfe_emit.empty:
-            df_plot = df_nfe_emit.copy()
-            df_plot['periodo_str'] = df_plot['periodo'].astype(str)
-            df_plot = df_plot.sort_values('periodo')
+            df_plot = df_nfe_emit.assign(periodo_str=df_nfe_emit['periodo'].astype(str))
             
-            fig = go.Figure()
-            fig.add_trace(go.Bar(
-                x=df_plot['periodo_str'],
-                y=df_plot['valor_total'],
-                name='Valor NFe Emitidas',
-                marker_color='#1e3c72'
-            ))
-            fig.update_layout(
-                title='NFe Emitidas - Valor por Período',
-                xaxis_title='Período',
-                xaxis={'type': 'category'},
-                yaxis_title='Valor (R$)',
-                height=350
+            fig = _fig_barra_periodo(
+                df_plot['periodo_str'], df_plot['valor_total'],
+                'Valor NFe Emitidas', 'NFe Emitidas - Valor por Período', '#1e3c72'
             )
             st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("Sem dados de NFe emitidas no período.")
     
     with col2:
-        df_nfe_rec = dados.get('nfe_recebidas_resumo', pd.DataFrame())
+        df_nfe_rec = dados.get('nfe_recebidas_resumo', _DF_VAZIO)
         if not df_nfe_rec.empty:
-            df_plot = df_nfe_rec.copy()
-            df_plot['periodo_str'] = df_plot['periodo'].astype(str)
-            df_plot = df_plot.sort_values('periodo')
+            df_plot = df_nfe_rec.assign(periodo_str=df_nfe_rec['periodo'].astype(str))
             
-            fig = go.Figure()
-            fig.add_trace(go.Bar(
-                x=df_plot['periodo_str'],
-                y=df_plot['valor_total'],
-                name='Valor NFe Recebidas',
-                marker_color='#2a5298'
-            ))
-            fig.update_layout(
-                title='NFe Recebidas - Valor por Período',
-                xaxis_title='Período',
-                xaxis={'type': 'category'},
-                yaxis_title='Valor (R$)',
-                height=350
+            fig = _fig_barra_periodo(
+                df_plot['periodo_str'], df_plot['valor_total'],
+                'Valor NFe Recebidas', 'NFe Recebidas - Valor por Período', '#2a5298'
             )
             st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("Sem dados de NFe recebidas no período.")
     
     # NFCe
-    df_nfce = dados.get('nfce_resumo', pd.DataFrame())
+    df_nfce = dados.get('nfce_resumo', _DF_VAZIO)
     if not df_nfce.empty:
-        df_plot = df_nfce.copy()
-        df_plot['periodo_str'] = df_plot['periodo'].astype(str)
-        df_plot = df_plot.sort_values('periodo')
+        df_plot = df_nfce.assign(periodo_str=df_nfce['periodo'].astype(str))
         
-        fig = go.Figure()
-        fig.add_trace(go.Bar(
-            x=df_plot['periodo_str'],
-            y=df_plot['valor_total'],
-            name='Valor NFCe',
-            marker_color='#28a745'
-        ))
-        fig.add_trace(go.Scatter(
-            x=df_plot['periodo_str'],
-            y=df_plot['qtd_notas'],
-            name='Qtd. Notas',
-            yaxis='y2',
-            line=dict(color='#dc3545', width=2)
-        ))
-        fig.update_layout(
-            title='NFCe - Valor e Quantidade por Período',
-            xaxis_title='Período',
-            xaxis={'type': 'category'},
-            yaxis=dict(title='Valor (R$)', side='left'),
-            yaxis2=dict(title='Quantidade', side='right', overlaying='y'),
-            height=350,
-            legend=dict(x=0, y=1.15, orientation='h')
+        fig = _fig_nfce_periodo(
+            df_plot['periodo_str'], df_plot['valor_total'], df_plot['qtd_notas']
         )
         st.plotly_chart(fig, use_container_width=True)
 
@@ -1259,8 +1642,8 @@ def render_tab_visao_geral(dados: Dict, periodo_inicio: int, periodo_fim: int):
 def render_tab_produtos(dados: Dict, tipo: str = 'nfe'):
     """Renderiza aba de produtos - apenas tabelas sem gráficos."""
     
-    df_ncm = dados.get(f'top_ncm_{tipo}', pd.DataFrame())
-    df_prod = dados.get(f'top_produtos_{tipo}', pd.DataFrame())
+    df_ncm = dados.get(f'top_ncm_{tipo}', _DF_VAZIO)
+    df_prod = dados.get(f'top_produtos_{tipo}', _DF_VAZIO)
     
     # Verificar se há dados disponíveis
     if df_ncm.empty and df_prod.empty:
@@ -1276,15 +1659,13 @@ def render_tab_produtos(dados: Dict, tipo: str = 'nfe'):
     st.markdown("### 📦 Top NCM por Valor")
     
     if not df_ncm.empty:
-        df_display = df_ncm.copy()
+        # Somente leitura: sem cópia; assign só quando a descrição é truncada
+        df_display = df_ncm
         if 'descricao_ncm' in df_display.columns:
-            df_display['descricao_ncm'] = df_display['descricao_ncm'].apply(
-                lambda x: x[:60] + '...' if len(str(x)) > 60 else x
-            )
+            df_display = df_ncm.assign(descricao_ncm=truncar_texto_series(df_ncm['descricao_ncm'], 60))
         
         # Calcular max para barras de progresso
-        max_valor = df_display['valor_total'].max() if not df_display['valor_total'].empty else 1
-        max_itens = df_display['qtd_itens'].max() if not df_display['qtd_itens'].empty else 1
+        max_valor, max_itens = df_display[['valor_total', 'qtd_itens']].max() if not df_display.empty else (1, 1)
         
         # Selecionar colunas para exibição
         colunas = ['ncm', 'valor_total', 'qtd_notas', 'qtd_itens']
@@ -1312,8 +1693,8 @@ def render_tab_produtos(dados: Dict, tipo: str = 'nfe'):
     st.markdown("### 🏷️ Top Produtos por Valor")
     
     if not df_prod.empty:
-        df_display = df_prod.head(20).copy()
-        df_display['descricao'] = df_display['descricao'].apply(lambda x: x[:50] + '...' if len(str(x)) > 50 else x)
+        df_top = df_prod.head(20)
+        df_display = df_top.assign(descricao=truncar_texto_series(df_top['descricao'], 50))
         
         # Calcular max para barras
         max_valor = df_display['valor_total'].max() if not df_display['valor_total'].empty else 1
@@ -1348,7 +1729,7 @@ def render_tab_produtos(dados: Dict, tipo: str = 'nfe'):
 def render_tab_clientes(dados: Dict):
     """Renderiza aba de clientes - tabela + concentração."""
     
-    df_clientes = dados.get('top_clientes', pd.DataFrame())
+    df_clientes = dados.get('top_clientes', _DF_VAZIO)
     
     if df_clientes.empty:
         st.info("Sem dados de clientes no período selecionado.")
@@ -1360,10 +1741,11 @@ def render_tab_clientes(dados: Dict):
         # Tabela detalhada
         st.markdown("### 👥 Top 10 Clientes por Valor")
         
-        df_display = df_clientes.copy()
-        total = df_display['valor_total'].sum()
-        df_display['participacao'] = df_display['valor_total'] / total * 100
-        df_display['cnpj_fmt'] = df_display['cnpj_cliente'].apply(formatar_cnpj)
+        total = df_clientes['valor_total'].sum()
+        df_display = df_clientes.assign(
+            participacao=df_clientes['valor_total'] / total * 100,
+            cnpj_fmt=df_clientes['cnpj_cliente'].map(formatar_cnpj)
+        )
         
         # Max para barras
         max_valor = df_display['valor_total'].max()
@@ -1385,7 +1767,7 @@ def render_tab_clientes(dados: Dict):
     with col2:
         st.markdown("### 📊 Concentração")
         
-        valores = df_clientes['valor_total'].tolist()
+        valores = df_clientes['valor_total'].to_numpy(dtype=np.float64)
         indices = calcular_indice_concentracao(valores)
         
         st.metric("Índice HHI", f"{indices['hhi']:,.0f}")
@@ -1404,7 +1786,7 @@ def render_tab_clientes(dados: Dict):
 def render_tab_fornecedores(dados: Dict):
     """Renderiza aba de fornecedores - tabela + concentração."""
     
-    df_fornecedores = dados.get('top_fornecedores', pd.DataFrame())
+    df_fornecedores = dados.get('top_fornecedores', _DF_VAZIO)
     
     if df_fornecedores.empty:
         st.info("Sem dados de fornecedores no período selecionado.")
@@ -1416,10 +1798,11 @@ def render_tab_fornecedores(dados: Dict):
         # Tabela detalhada
         st.markdown("### 🏭 Top 10 Fornecedores por Valor")
         
-        df_display = df_fornecedores.copy()
-        total = df_display['valor_total'].sum()
-        df_display['participacao'] = df_display['valor_total'] / total * 100
-        df_display['cnpj_fmt'] = df_display['cnpj_fornecedor'].apply(formatar_cnpj)
+        total = df_fornecedores['valor_total'].sum()
+        df_display = df_fornecedores.assign(
+            participacao=df_fornecedores['valor_total'] / total * 100,
+            cnpj_fmt=df_fornecedores['cnpj_fornecedor'].map(formatar_cnpj)
+        )
         
         # Max para barras
         max_valor = df_display['valor_total'].max()
@@ -1441,7 +1824,7 @@ def render_tab_fornecedores(dados: Dict):
     with col2:
         st.markdown("### 📊 Concentração")
         
-        valores = df_fornecedores['valor_total'].tolist()
+        valores = df_fornecedores['valor_total'].to_numpy(dtype=np.float64)
         indices = calcular_indice_concentracao(valores)
         
         st.metric("Índice HHI", f"{indices['hhi']:,.0f}")
@@ -1468,20 +1851,11 @@ def render_tab_faturamento(dados: Dict, cadastro: Dict):
         st.markdown("### 💰 Faturamento Declarado")
         
         if is_simples:
-            df_fat = dados.get('faturamento_pgdas', pd.DataFrame())
+            df_fat = dados.get('faturamento_pgdas', _DF_VAZIO)
             if not df_fat.empty:
-                fig = go.Figure()
-                fig.add_trace(go.Bar(
-                    x=df_fat['periodo'].astype(str),
-                    y=df_fat['receita_bruta'],
-                    name='Receita Bruta (PGDAS)',
-                    marker_color='#1e3c72'
-                ))
-                fig.update_layout(
-                    title='Faturamento PGDAS (Simples Nacional)',
-                    xaxis_title='Período',
-                    yaxis_title='Valor (R$)',
-                    height=350
+                fig = _fig_barra_periodo(
+                    df_fat['periodo'].astype(str), df_fat['receita_bruta'],
+                    'Receita Bruta (PGDAS)', 'Faturamento PGDAS (Simples Nacional)', '#1e3c72', eixo_categoria=False
                 )
                 st.plotly_chart(fig, use_container_width=True)
                 
@@ -1493,20 +1867,11 @@ def render_tab_faturamento(dados: Dict, cadastro: Dict):
             else:
                 st.info("Sem dados de PGDAS no período.")
         else:
-            df_fat = dados.get('faturamento_dime', pd.DataFrame())
+            df_fat = dados.get('faturamento_dime', _DF_VAZIO)
             if not df_fat.empty:
-                fig = go.Figure()
-                fig.add_trace(go.Bar(
-                    x=df_fat['periodo'].astype(str),
-                    y=df_fat['faturamento'],
-                    name='Faturamento (DIME)',
-                    marker_color='#1e3c72'
-                ))
-                fig.update_layout(
-                    title='Faturamento DIME (Regime Normal)',
-                    xaxis_title='Período',
-                    yaxis_title='Valor (R$)',
-                    height=350
+                fig = _fig_barra_periodo(
+                    df_fat['periodo'].astype(str), df_fat['faturamento'],
+                    'Faturamento (DIME)', 'Faturamento DIME (Regime Normal)', '#1e3c72', eixo_categoria=False
                 )
                 st.plotly_chart(fig, use_container_width=True)
                 
@@ -1521,50 +1886,31 @@ def render_tab_faturamento(dados: Dict, cadastro: Dict):
     with col2:
         st.markdown("### 📊 Comparativo: Declarado vs NFe/NFCe")
         
-        df_nfe = dados.get('nfe_emitidas_resumo', pd.DataFrame())
-        df_nfce = dados.get('nfce_resumo', pd.DataFrame())
+        df_nfe = dados.get('nfe_emitidas_resumo', _DF_VAZIO)
+        df_nfce = dados.get('nfce_resumo', _DF_VAZIO)
         
         if is_simples:
-            df_fat = dados.get('faturamento_pgdas', pd.DataFrame())
+            df_fat = dados.get('faturamento_pgdas', _DF_VAZIO)
             col_valor = 'receita_bruta'
         else:
-            df_fat = dados.get('faturamento_dime', pd.DataFrame())
+            df_fat = dados.get('faturamento_dime', _DF_VAZIO)
             col_valor = 'faturamento'
         
         if not df_fat.empty and (not df_nfe.empty or not df_nfce.empty):
-            # Preparar dados
-            df_fat['periodo'] = df_fat['periodo'].astype(str)
-            
-            # Iniciar com faturamento declarado
-            df_comp = df_fat[['periodo', col_valor]].copy()
-            df_comp = df_comp.rename(columns={col_valor: 'declarado'})
-            
-            # Adicionar NFe se houver
-            if not df_nfe.empty:
-                df_nfe_prep = df_nfe[['periodo', 'valor_total']].copy()
-                df_nfe_prep['periodo'] = df_nfe_prep['periodo'].astype(str)
-                df_nfe_prep = df_nfe_prep.rename(columns={'valor_total': 'nfe_valor'})
-                df_comp = pd.merge(df_comp, df_nfe_prep, on='periodo', how='outer')
-            else:
-                df_comp['nfe_valor'] = 0
-            
-            # Adicionar NFCe se houver
-            if not df_nfce.empty:
-                df_nfce_prep = df_nfce[['periodo', 'valor_total']].copy()
-                df_nfce_prep['periodo'] = df_nfce_prep['periodo'].astype(str)
-                df_nfce_prep = df_nfce_prep.rename(columns={'valor_total': 'nfce_valor'})
-                df_comp = pd.merge(df_comp, df_nfce_prep, on='periodo', how='outer')
-            else:
-                df_comp['nfce_valor'] = 0
-            
-            df_comp = df_comp.fillna(0)
+            # Séries indexadas por período (texto) e um único join externo; o frame
+            # de dados na sessão não é alterado
+            df_comp = df_fat.set_index(df_fat['periodo'].astype(str))[[col_valor]].rename(columns={col_valor: 'declarado'})
+            notas = [
+                df_notas.set_index(df_notas['periodo'].astype(str))['valor_total'].rename(coluna)
+                for df_notas, coluna in ((df_nfe, 'nfe_valor'), (df_nfce, 'nfce_valor'))
+                if not df_notas.empty
+            ]
+            df_comp = df_comp.join(notas, how='outer')
+            df_comp = df_comp.reindex(columns=['declarado', 'nfe_valor', 'nfce_valor'], fill_value=0)
+            df_comp = df_comp.fillna(0).reset_index()
             df_comp['total_notas'] = df_comp['nfe_valor'] + df_comp['nfce_valor']
             df_comp['diferenca'] = df_comp['total_notas'] - df_comp['declarado']
-            df_comp['diferenca_pct'] = np.where(
-                df_comp['declarado'] > 0,
-                (df_comp['diferenca'] / df_comp['declarado']) * 100,
-                0
-            )
+            df_comp['diferenca_pct'] = percentual_seguro(df_comp['diferenca'], df_comp['declarado'])
             df_comp = df_comp.sort_values('periodo')
             
             fig = go.Figure()
@@ -1608,10 +1954,20 @@ def render_tab_faturamento(dados: Dict, cadastro: Dict):
             st.info("Dados insuficientes para comparativo.")
 
 
+# Origem da mercadoria (tabela A do CST), montada uma vez: o map por Series
+# resolve os códigos com um get_indexer sobre o índice
+_ORIGEM_DESC = pd.Series({
+    0: 'Nacional', 1: 'Estrangeira (Importação Direta)',
+    2: 'Estrangeira (Mercado Interno)', 3: 'Nacional (40-70% Conteúdo)',
+    4: 'Nacional (Processos Básicos)', 5: 'Nacional (<40% Conteúdo)',
+    6: 'Estrangeira (Sem Similar)', 7: 'Estrangeira (Sem Similar)',
+    8: 'Nacional (70% Conteúdo Importado)'
+})
+
 def render_tab_tributacao(dados: Dict):
     """Renderiza aba de tributação."""
     
-    df_trib = dados.get('tributacao_nfe', pd.DataFrame())
+    df_trib = dados.get('tributacao_nfe', _DF_VAZIO)
     
     if df_trib.empty:
         st.warning("""
@@ -1627,11 +1983,7 @@ def render_tab_tributacao(dados: Dict):
     with col1:
         st.markdown("### 📊 Distribuição por CST/CSOSN")
         
-        df_cst = df_trib.groupby('cst').agg({
-            'valor_produtos': 'sum',
-            'icms_total': 'sum',
-            'qtd_itens': 'sum'
-        }).reset_index()
+        df_cst = somar_por(df_trib, 'cst', ['valor_produtos', 'icms_total', 'qtd_itens'])
         
         fig = px.pie(
             df_cst,
@@ -1646,17 +1998,8 @@ def render_tab_tributacao(dados: Dict):
     with col2:
         st.markdown("### 🌍 Distribuição por Origem")
         
-        origem_map = {0: 'Nacional', 1: 'Estrangeira (Importação Direta)', 
-                      2: 'Estrangeira (Mercado Interno)', 3: 'Nacional (40-70% Conteúdo)',
-                      4: 'Nacional (Processos Básicos)', 5: 'Nacional (<40% Conteúdo)',
-                      6: 'Estrangeira (Sem Similar)', 7: 'Estrangeira (Sem Similar)',
-                      8: 'Nacional (70% Conteúdo Importado)'}
-        
-        df_origem = df_trib.groupby('origem').agg({
-            'valor_produtos': 'sum',
-            'icms_total': 'sum'
-        }).reset_index()
-        df_origem['origem_desc'] = df_origem['origem'].map(origem_map).fillna('Outros')
+        df_origem = somar_por(df_trib, 'origem', ['valor_produtos', 'icms_total'])
+        df_origem['origem_desc'] = df_origem['origem'].map(_ORIGEM_DESC).fillna('Outros')
         
         fig = px.pie(
             df_origem,
@@ -1674,13 +2017,7 @@ def render_tab_tributacao(dados: Dict):
     if 'grupo_tributacao' in df_trib.columns:
         st.markdown("### 📋 Resumo por Grupo de Tributação")
         
-        df_grupo = df_trib.groupby('grupo_tributacao').agg({
-            'valor_produtos': 'sum',
-            'icms_total': 'sum',
-            'base_calculo_total': 'sum',
-            'qtd_itens': 'sum',
-            'qtd_notas': 'sum'
-        }).reset_index()
+        df_grupo = somar_por(df_trib, 'grupo_tributacao', ['valor_produtos', 'icms_total', 'base_calculo_total', 'qtd_itens', 'qtd_notas'])
         
         fig = px.bar(
             df_grupo,
@@ -1695,20 +2032,14 @@ def render_tab_tributacao(dados: Dict):
     
     st.markdown("### 💹 Detalhamento por CST")
     
-    # Tabela detalhada
-    df_display = df_trib.copy()
-    df_display['aliquota_efetiva'] = np.where(
-        df_display['valor_produtos'] > 0,
-        (df_display['icms_total'] / df_display['valor_produtos']) * 100,
-        0
+    # Tabela detalhada: 20 maiores (NaN por último, sem descartar linhas), alíquota só sobre eles
+    df_display = df_trib.sort_values('valor_produtos', ascending=False).head(20)
+    df_display = df_display.assign(
+        aliquota_efetiva=percentual_seguro(df_display['icms_total'], df_display['valor_produtos'])
     )
     
-    # Ordenar
-    df_display = df_display.sort_values('valor_produtos', ascending=False).head(20)
-    
     # Max para barras
-    max_valor = df_display['valor_produtos'].max() if not df_display['valor_produtos'].empty else 1
-    max_icms = df_display['icms_total'].max() if not df_display['icms_total'].empty else 1
+    max_valor, max_icms = df_display[['valor_produtos', 'icms_total']].max() if not df_display.empty else (1, 1)
     
     # Selecionar colunas para exibição
     colunas_exib = ['cst', 'origem', 'valor_produtos', 'base_calculo_total', 'icms_total', 'aliquota_media', 'aliquota_efetiva', 'qtd_itens', 'qtd_notas']
@@ -1734,6 +2065,52 @@ def render_tab_tributacao(dados: Dict):
     )
 
 
+@st.cache_data(ttl=86400, show_spinner=False)
+def _periodo_mais_recente_argos() -> int:
+    """Período mais recente do ARGOS (muda no máximo uma vez por mês).
+    executar_query_cached devolve DataFrame vazio em caso de erro; nesse caso (ou
+    sem período) levanta exceção, que o st.cache_data não guarda, em vez de cachear
+    None por um dia. O chamador aplica o fallback."""
+    df_periodo = executar_query_cached(
+        NotasQueries.get_periodo_mais_recente_argos(),
+        _cache_key="argos_periodo_recente"
+    )
+    if df_periodo.empty or not df_periodo.iloc[0]['periodo_mais_recente']:
+        raise ValueError("Período mais recente do ARGOS indisponível")
+    return int(df_periodo.iloc[0]['periodo_mais_recente'])
+
+# (emoji, cor) do card "Sua Empresa vs Setor" por status_vs_setor
+_STATUS_SETOR_CORES: Dict[str, Tuple[str, str]] = {
+    'MUITO_ABAIXO': ('🔴', '#dc3545'),
+    'ABAIXO': ('🟠', '#fd7e14'),
+    'NORMAL': ('🟢', '#28a745'),
+    'ACIMA': ('🟡', '#ffc107'),
+    'MUITO_ACIMA': ('🔴', '#dc3545'),
+    'SEM_DADOS': ('⚪', '#6c757d')
+}
+
+# (posicao, cor, emoji) do card de posicionamento, do nível mais baixo ao mais alto
+_POSICOES_FATURAMENTO: Tuple[Tuple[str, str, str], ...] = (
+    ("Quartil Inferior", "#dc3545", "⚠️"),
+    ("Abaixo da Mediana", "#fd7e14", "📉"),
+    ("Acima da Mediana", "#ffc107", "📊"),
+    ("Top 25%", "#17a2b8", "🥈"),
+    ("Top 10%", "#28a745", "🏆"),
+)
+
+def nivel_posicao_faturamento(faturamento, minimo: float, mediana: float, maximo: float) -> np.ndarray:
+    """
+    Índice em _POSICOES_FATURAMENTO para um ou vários faturamentos (searchsorted).
+    Limiares: metade do caminho até a mediana, mediana e 75%/90% da amplitude
+    mínimo-máximo (ignorados se a amplitude for nula). Cada limiar é limitado pelos
+    seguintes para que o nível mais alto atingido prevaleça; limiar nulo nunca é atingido.
+    """
+    amplitude = maximo - minimo
+    cortes_topo = [minimo + amplitude * 0.75, minimo + amplitude * 0.9] if amplitude > 0 else [np.inf, np.inf]
+    limiares = np.array([minimo + (mediana - minimo) / 2, mediana, *cortes_topo], dtype=np.float64)
+    limiares = np.minimum.accumulate(np.nan_to_num(limiares, nan=np.inf)[::-1])[::-1]
+    return np.searchsorted(limiares, np.nan_to_num(faturamento, nan=-np.inf), side='right')
+
 def render_tab_setor(dados: Dict, cadastro: Dict):
     """Renderiza aba de comparação setorial com análises ARGOS."""
     
@@ -1748,23 +2125,27 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
     
     # Buscar período mais recente disponível no ARGOS
     try:
-        df_periodo = executar_query_cached(
-            NotasQueries.get_periodo_mais_recente_argos(),
-            _cache_key="argos_periodo_recente"
-        )
-        if not df_periodo.empty and df_periodo.iloc[0]['periodo_mais_recente']:
-            periodo_argos = int(df_periodo.iloc[0]['periodo_mais_recente'])
-        else:
-            periodo_argos = 202508  # fallback
+        periodo_argos = _periodo_mais_recente_argos()
     except:
         periodo_argos = 202508  # fallback
     
     st.caption(f"📅 Dados ARGOS referentes ao período: **{periodo_argos}**")
     
+    # Consultas ARGOS independentes entre si: disparadas juntas agora e consumidas
+    # seção a seção, o tempo passa a ser o da mais lenta. Falha de uma só esvazia a sua seção.
+    futuros_argos = submeter_queries({
+        'benchmark': NotasQueries.get_benchmark_setorial(cnae, periodo_argos),
+        'empresa_bench': NotasQueries.get_empresa_vs_benchmark(cnpj, periodo_argos),
+        'porte': NotasQueries.get_benchmark_por_porte(cnae, periodo_argos),
+        'alertas': NotasQueries.get_alertas_empresa(cnpj, periodo_argos),
+        'empresas_setor': NotasQueries.get_empresas_setor(cnae, periodo_argos, 20),
+        'alertas_setor': NotasQueries.get_alertas_setor(cnae, periodo_argos, 15),
+    })
+    
     # =========================================================================
     # SEÇÃO 1: Dados básicos do setor (query original)
     # =========================================================================
-    df_setor = dados.get('setor_stats', pd.DataFrame())
+    df_setor = dados.get('setor_stats', _DF_VAZIO)
     
     if not df_setor.empty:
         stats = df_setor.iloc[0].to_dict()
@@ -1778,7 +2159,8 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
         with col2:
             st.metric("📊 Média do Setor", formatar_moeda(stats.get('media_faturamento', 0)))
         with col3:
-            st.metric("📈 Mediana do Setor", formatar_moeda(stats.get('mediana_faturamento', 0)))
+            st.metric("📈 Mediana do Setor", formatar_moeda(stats.get('mediana_faturamento', 0)),
+                      help="Mediana aproximada (APPX_MEDIAN do Impala).")
         with col4:
             st.metric("💰 Seu Faturamento NFe", formatar_moeda(faturamento_empresa))
     
@@ -1790,19 +2172,8 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
     st.markdown("### 📊 Benchmark Setorial (ARGOS)")
     
     # Tentar buscar dados ARGOS usando período mais recente e CNAE 5 dígitos
-    try:
-        df_benchmark = executar_query_cached(
-            NotasQueries.get_benchmark_setorial(cnae, periodo_argos),
-            _cache_key=f"argos_bench_{cnae[:5]}_{periodo_argos}"
-        )
-        
-        df_empresa_bench = executar_query_cached(
-            NotasQueries.get_empresa_vs_benchmark(cnpj, periodo_argos),
-            _cache_key=f"argos_emp_bench_{cnpj}_{periodo_argos}"
-        )
-    except Exception as e:
-        df_benchmark = pd.DataFrame()
-        df_empresa_bench = pd.DataFrame()
+    df_benchmark = resultado_ou_vazio(futuros_argos['benchmark'])
+    df_empresa_bench = resultado_ou_vazio(futuros_argos['empresa_bench'])
     
     if not df_benchmark.empty:
         bench = df_benchmark.iloc[0]
@@ -1841,16 +2212,7 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
                 if pd.isna(status):
                     status = 'SEM_DADOS'
                 
-                status_colors = {
-                    'MUITO_ABAIXO': ('🔴', '#dc3545'),
-                    'ABAIXO': ('🟠', '#fd7e14'),
-                    'NORMAL': ('🟢', '#28a745'),
-                    'ACIMA': ('🟡', '#ffc107'),
-                    'MUITO_ACIMA': ('🔴', '#dc3545'),
-                    'SEM_DADOS': ('⚪', '#6c757d')
-                }
-                
-                emoji, cor = status_colors.get(status, ('⚪', '#6c757d'))
+                emoji, cor = _STATUS_SETOR_CORES.get(status, ('⚪', '#6c757d'))
                 
                 st.markdown(f"""
                 <div style='background-color: {cor}; color: white; padding: 20px; border-radius: 10px; text-align: center;'>
@@ -1868,20 +2230,12 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
                 aliq_p25 = (aliq_p25_raw * 100) if pd.notna(aliq_p25_raw) else 0
                 aliq_p75 = (aliq_p75_raw * 100) if pd.notna(aliq_p75_raw) else 0
                 
-                dados_comp = pd.DataFrame({
-                    'Tipo': ['Sua Empresa', 'Setor P25', 'Setor Mediana', 'Setor P75'],
-                    'Alíquota': [aliq_empresa, aliq_p25, aliq_setor, aliq_p75]
-                })
-                
-                fig = px.bar(
-                    dados_comp,
-                    x='Tipo',
-                    y='Alíquota',
-                    title="Comparação de Alíquota Efetiva (%)",
-                    color='Tipo',
-                    color_discrete_sequence=['#dc3545', '#28a745', '#1e3c72', '#ffc107']
+                fig = _fig_barra_categorias(
+                    ['Sua Empresa', 'Setor P25', 'Setor Mediana', 'Setor P75'],
+                    [aliq_empresa, aliq_p25, aliq_setor, aliq_p75],
+                    ['#dc3545', '#28a745', '#1e3c72', '#ffc107'],
+                    "Comparação de Alíquota Efetiva (%)", 'Tipo', 'Alíquota'
                 )
-                fig.update_layout(showlegend=False, height=350)
                 st.plotly_chart(fig, use_container_width=True)
     else:
         st.info("ℹ️ Dados ARGOS não disponíveis para este setor/período. Exibindo análise baseada nas notas fiscais.")
@@ -1893,13 +2247,7 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
     # =========================================================================
     st.markdown("### 📊 Distribuição por Porte Empresarial")
     
-    try:
-        df_porte = executar_query_cached(
-            NotasQueries.get_benchmark_por_porte(cnae, periodo_argos),
-            _cache_key=f"argos_porte_{cnae[:5]}_{periodo_argos}"
-        )
-    except:
-        df_porte = pd.DataFrame()
+    df_porte = resultado_ou_vazio(futuros_argos['porte'])
     
     if not df_porte.empty:
         col1, col2 = st.columns(2)
@@ -1907,31 +2255,17 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
         with col1:
             df_porte['aliq_mediana_pct'] = df_porte['aliq_efetiva_mediana'] * 100
             
-            fig = px.bar(
-                df_porte,
-                x='porte_empresa',
-                y='aliq_mediana_pct',
-                title="Alíquota Mediana por Porte",
-                labels={'porte_empresa': 'Porte', 'aliq_mediana_pct': 'Alíquota (%)'},
-                color='porte_empresa',
-                color_discrete_sequence=px.colors.qualitative.Set2
+            fig = _fig_barra_categorias(
+                df_porte['porte_empresa'], df_porte['aliq_mediana_pct'], px.colors.qualitative.Set2,
+                "Alíquota Mediana por Porte", 'Porte', 'Alíquota (%)'
             )
-            fig.update_layout(showlegend=False, height=350)
             st.plotly_chart(fig, use_container_width=True)
         
         with col2:
-            df_porte['faturamento_medio_mi'] = df_porte['faturamento_medio'] / 1e6
-            
-            fig = px.bar(
-                df_porte,
-                x='porte_empresa',
-                y='qtd_empresas',
-                title="Quantidade de Empresas por Porte",
-                labels={'porte_empresa': 'Porte', 'qtd_empresas': 'Qtd Empresas'},
-                color='porte_empresa',
-                color_discrete_sequence=px.colors.qualitative.Set2
+            fig = _fig_barra_categorias(
+                df_porte['porte_empresa'], df_porte['qtd_empresas'], px.colors.qualitative.Set2,
+                "Quantidade de Empresas por Porte", 'Porte', 'Qtd Empresas'
             )
-            fig.update_layout(showlegend=False, height=350)
             st.plotly_chart(fig, use_container_width=True)
         
         # Tabela detalhada
@@ -1953,13 +2287,7 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
     # =========================================================================
     st.markdown("### ⚠️ Alertas e Riscos")
     
-    try:
-        df_alertas = executar_query_cached(
-            NotasQueries.get_alertas_empresa(cnpj, periodo_argos),
-            _cache_key=f"argos_alertas_{cnpj}_{periodo_argos}"
-        )
-    except:
-        df_alertas = pd.DataFrame()
+    df_alertas = resultado_ou_vazio(futuros_argos['alertas'])
     
     if not df_alertas.empty:
         for _, alerta in df_alertas.iterrows():
@@ -1985,27 +2313,15 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
     # =========================================================================
     st.markdown("### 🏢 Empresas do Setor (Top 20 por Faturamento)")
     
-    try:
-        df_empresas_setor = executar_query_cached(
-            NotasQueries.get_empresas_setor(cnae, periodo_argos, 20),
-            _cache_key=f"argos_empresas_{cnae[:5]}_{periodo_argos}"
-        )
-    except:
-        df_empresas_setor = pd.DataFrame()
+    df_empresas_setor = resultado_ou_vazio(futuros_argos['empresas_setor'])
     
     if not df_empresas_setor.empty:
         # Destacar a empresa atual na lista
-        df_display = df_empresas_setor.copy()
-        df_display['aliq_pct'] = df_display['aliq_efetiva_empresa'] * 100
-        df_display['faturamento_mi'] = df_display['vl_faturamento'] / 1e6
-        
         # Formatar CNPJ
-        df_display['cnpj_fmt'] = df_display['nu_cnpj'].apply(
-            lambda x: formatar_cnpj(str(x).zfill(14)) if pd.notna(x) else ''
-        )
+        df_display = df_empresas_setor.assign(cnpj_fmt=formatar_cnpj_series(df_empresas_setor['nu_cnpj']))
         
         # Verificar se a empresa atual está na lista
-        empresa_na_lista = df_display[df_display['nu_cnpj'].astype(str).str.replace('[^0-9]', '', regex=True) == cnpj]
+        empresa_na_lista = df_display[limpar_cnpj_series(df_display['nu_cnpj']) == cnpj]
         if not empresa_na_lista.empty:
             posicao = empresa_na_lista.index[0] + 1
             st.success(f"🎯 Sua empresa está na posição **{posicao}º** entre as maiores do setor.")
@@ -2035,18 +2351,10 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
     # =========================================================================
     st.markdown("### 🎯 Empresas do Setor com Alertas de Risco")
     
-    try:
-        df_alertas_setor = executar_query_cached(
-            NotasQueries.get_alertas_setor(cnae, periodo_argos, 15),
-            _cache_key=f"argos_alertas_setor_{cnae[:5]}_{periodo_argos}"
-        )
-    except:
-        df_alertas_setor = pd.DataFrame()
+    df_alertas_setor = resultado_ou_vazio(futuros_argos['alertas_setor'])
     
     if not df_alertas_setor.empty:
-        df_alertas_setor['cnpj_fmt'] = df_alertas_setor['nu_cnpj'].apply(
-            lambda x: formatar_cnpj(str(x).zfill(14)) if pd.notna(x) else ''
-        )
+        df_alertas_setor = df_alertas_setor.assign(cnpj_fmt=formatar_cnpj_series(df_alertas_setor['nu_cnpj']))
         
         max_score = df_alertas_setor['score_risco'].max()
         if pd.isna(max_score):
@@ -2084,17 +2392,22 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
         metricas = dados.get('metricas', {})
         faturamento_empresa = metricas.get('nfe_emitidas_valor', 0)
         
+        percentis = {
+            'Mínimo': stats.get('min_faturamento', 0),
+            'Mediana': stats.get('mediana_faturamento', 0),
+            'Média': stats.get('media_faturamento', 0),
+            'Máximo': stats.get('max_faturamento', 0)
+        }
+        
+        # Sem estatísticas (tudo nulo/zero): não monta gráfico nem card vazios
+        if not any(pd.notna(v) and v for v in percentis.values()):
+            st.info("Estatísticas de faturamento do setor não disponíveis.")
+            return
+        
         col1, col2 = st.columns(2)
         
         with col1:
             # Gráfico de distribuição
-            percentis = {
-                'Mínimo': stats.get('min_faturamento', 0),
-                'Mediana': stats.get('mediana_faturamento', 0),
-                'Média': stats.get('media_faturamento', 0),
-                'Máximo': stats.get('max_faturamento', 0)
-            }
-            
             fig = go.Figure()
             fig.add_trace(go.Bar(
                 x=list(percentis.keys()),
@@ -2122,21 +2435,9 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
             minimo = stats.get('min_faturamento') or 0
             maximo = stats.get('max_faturamento') or 0
 
-            if maximo > minimo:
-                percentil_aprox = ((faturamento_empresa - minimo) / (maximo - minimo)) * 100
-            else:
-                percentil_aprox = 50
-            
-            if percentil_aprox >= 90:
-                posicao, cor, emoji = "Top 10%", "#28a745", "🏆"
-            elif percentil_aprox >= 75:
-                posicao, cor, emoji = "Top 25%", "#17a2b8", "🥈"
-            elif faturamento_empresa >= mediana:
-                posicao, cor, emoji = "Acima da Mediana", "#ffc107", "📊"
-            elif faturamento_empresa >= minimo + (mediana - minimo) / 2:
-                posicao, cor, emoji = "Abaixo da Mediana", "#fd7e14", "📉"
-            else:
-                posicao, cor, emoji = "Quartil Inferior", "#dc3545", "⚠️"
+            posicao, cor, emoji = _POSICOES_FATURAMENTO[
+                int(nivel_posicao_faturamento(faturamento_empresa, minimo, mediana, maximo))
+            ]
             
             st.markdown(f"""
             <div style='background-color: {cor}; color: white; padding: 30px; border-radius: 10px; text-align: center;'>
@@ -2154,10 +2455,79 @@ def render_tab_setor(dados: Dict, cadastro: Dict):
                     st.warning(f"⚠️ Seu faturamento está **{abs(desvio):.1f}% abaixo** da média do setor.")
 
 
+# Categorias de TTD exibidas na aba de benefícios ('outros' recebe os códigos não listados)
+_TTD_CATEGORIAS = {
+    'importacao': {
+        'nome': '🚢 Importação',
+        'codigos': [409, 410, 411, 412, 413, 414, 415, 416, 417, 418, 419, 420],
+        'descricao': 'Benefícios para operações de importação'
+    },
+    'atacadista': {
+        'nome': '🏪 Atacadista',
+        'codigos': [9],
+        'descricao': 'Crédito presumido para atacadistas'
+    },
+    'diferimento': {
+        'nome': '📋 Diferimento',
+        'codigos': [1010, 1011, 1012],
+        'descricao': 'Diferimento do ICMS'
+    },
+    'outros': {
+        'nome': '📄 Outros Benefícios',
+        'codigos': [],  # Todos que não se encaixam nas categorias acima
+        'descricao': 'Outros tratamentos tributários diferenciados'
+    }
+}
+_TTD_CATEGORIA_POR_CODIGO = {
+    codigo: cat_key for cat_key, cat_info in _TTD_CATEGORIAS.items() for codigo in cat_info['codigos']
+}
+
+
+def _ttd_card_html(ttd: Dict) -> str:
+    """Monta o card HTML de um TTD (os cards de uma categoria vão em um único st.markdown)."""
+    cd = ttd['cd_beneficio']
+    descricao = ttd['de_beneficio']
+    periodo_inicio = ttd['periodo_inicio']
+    periodo_fim = ttd['periodo_fim']
+    estado = ttd['estado']
+    
+    # Determinar cor do estado
+    if estado == 'ATIVO':
+        cor_estado = '#28a745'
+        icone_estado = '✅'
+    else:
+        cor_estado = '#ffc107'
+        icone_estado = '⚠️'
+    
+    return f"""
+    <div style='background: linear-gradient(135deg, #f8f9fa, #e9ecef); 
+                padding: 15px; border-radius: 8px; margin-bottom: 10px;
+                border-left: 4px solid {cor_estado};'>
+        <div style='display: flex; justify-content: space-between; align-items: center;'>
+            <div>
+                <h4 style='margin: 0; color: #1e3c72;'>TTD {cd}</h4>
+                <p style='margin: 5px 0; color: #666; font-size: 0.9em;'>{descricao}</p>
+            </div>
+            <div style='text-align: right;'>
+                <span style='background-color: {cor_estado}; color: white; 
+                             padding: 3px 10px; border-radius: 15px; font-size: 0.8em;'>
+                    {icone_estado} {estado}
+                </span>
+            </div>
+        </div>
+        <div style='margin-top: 10px; padding-top: 10px; border-top: 1px solid #dee2e6;'>
+            <span style='color: #666; font-size: 0.85em;'>
+                📅 <strong>Vigência:</strong> {periodo_inicio} a {periodo_fim if periodo_fim != 209912 else 'Indeterminado'}
+            </span>
+        </div>
+    </div>
+    """
+
+
 def render_tab_ttd(dados: Dict, cadastro: Dict):
     """Renderiza aba de TTDs (benefícios fiscais) com seções colapsáveis."""
     
-    df_ttd = dados.get('ttd_empresa', pd.DataFrame())
+    df_ttd = dados.get('ttd_empresa', _DF_VAZIO)
     
     st.markdown("### 🎫 Tratamentos Tributários Diferenciados (TTDs)")
     
@@ -2171,108 +2541,32 @@ def render_tab_ttd(dados: Dict, cadastro: Dict):
     
     st.markdown("---")
     
-    # Dicionário de categorias de TTD
-    ttd_categorias = {
-        'importacao': {
-            'nome': '🚢 Importação',
-            'codigos': [409, 410, 411, 412, 413, 414, 415, 416, 417, 418, 419, 420],
-            'descricao': 'Benefícios para operações de importação'
-        },
-        'atacadista': {
-            'nome': '🏪 Atacadista',
-            'codigos': [9],
-            'descricao': 'Crédito presumido para atacadistas'
-        },
-        'diferimento': {
-            'nome': '📋 Diferimento',
-            'codigos': [1010, 1011, 1012],
-            'descricao': 'Diferimento do ICMS'
-        },
-        'outros': {
-            'nome': '📄 Outros Benefícios',
-            'codigos': [],  # Todos que não se encaixam nas categorias acima
-            'descricao': 'Outros tratamentos tributários diferenciados'
-        }
+    # Agrupar TTDs por categoria (ordem de primeira ocorrência, 'outros' por último)
+    categoria = df_ttd['cd_beneficio'].map(_TTD_CATEGORIA_POR_CODIGO).fillna('outros')
+    ttds_por_categoria = {
+        cat_key: sub.to_dict('records')
+        for cat_key, sub in df_ttd.groupby(categoria, sort=False)
     }
-    
-    # Agrupar TTDs por categoria
-    ttds_por_categoria = {}
-    ttds_outros = []
-    
-    for _, row in df_ttd.iterrows():
-        cd_beneficio = row['cd_beneficio']
-        encontrou_categoria = False
-        
-        for cat_key, cat_info in ttd_categorias.items():
-            if cat_key != 'outros' and cd_beneficio in cat_info['codigos']:
-                if cat_key not in ttds_por_categoria:
-                    ttds_por_categoria[cat_key] = []
-                ttds_por_categoria[cat_key].append(row)
-                encontrou_categoria = True
-                break
-        
-        if not encontrou_categoria:
-            ttds_outros.append(row)
-    
-    if ttds_outros:
-        ttds_por_categoria['outros'] = ttds_outros
+    if 'outros' in ttds_por_categoria:
+        ttds_por_categoria['outros'] = ttds_por_categoria.pop('outros')
     
     # Renderizar cada categoria como expander
     for cat_key, ttds in ttds_por_categoria.items():
-        cat_info = ttd_categorias[cat_key]
+        cat_info = _TTD_CATEGORIAS[cat_key]
         qtd = len(ttds)
         
         with st.expander(f"{cat_info['nome']} ({qtd} TTD{'s' if qtd > 1 else ''})", expanded=(qtd <= 2)):
             st.caption(cat_info['descricao'])
             
-            for ttd in ttds:
-                cd = ttd['cd_beneficio']
-                descricao = ttd['de_beneficio']
-                periodo_inicio = ttd['periodo_inicio']
-                periodo_fim = ttd['periodo_fim']
-                estado = ttd['estado']
-                
-                # Determinar cor do estado
-                if estado == 'ATIVO':
-                    cor_estado = '#28a745'
-                    icone_estado = '✅'
-                else:
-                    cor_estado = '#ffc107'
-                    icone_estado = '⚠️'
-                
-                # Card do TTD
-                st.markdown(f"""
-                <div style='background: linear-gradient(135deg, #f8f9fa, #e9ecef); 
-                            padding: 15px; border-radius: 8px; margin-bottom: 10px;
-                            border-left: 4px solid {cor_estado};'>
-                    <div style='display: flex; justify-content: space-between; align-items: center;'>
-                        <div>
-                            <h4 style='margin: 0; color: #1e3c72;'>TTD {cd}</h4>
-                            <p style='margin: 5px 0; color: #666; font-size: 0.9em;'>{descricao}</p>
-                        </div>
-                        <div style='text-align: right;'>
-                            <span style='background-color: {cor_estado}; color: white; 
-                                         padding: 3px 10px; border-radius: 15px; font-size: 0.8em;'>
-                                {icone_estado} {estado}
-                            </span>
-                        </div>
-                    </div>
-                    <div style='margin-top: 10px; padding-top: 10px; border-top: 1px solid #dee2e6;'>
-                        <span style='color: #666; font-size: 0.85em;'>
-                            📅 <strong>Vigência:</strong> {periodo_inicio} a {periodo_fim if periodo_fim != 209912 else 'Indeterminado'}
-                        </span>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
+            st.markdown(''.join(_ttd_card_html(ttd) for ttd in ttds), unsafe_allow_html=True)
     
     st.markdown("---")
     
     # Resumo em tabela colapsável
     with st.expander("📋 Ver tabela completa de TTDs"):
-        df_display = df_ttd.copy()
-        df_display['periodo_fim'] = df_display['periodo_fim'].apply(
+        df_display = df_ttd.assign(periodo_fim=df_ttd['periodo_fim'].apply(
             lambda x: 'Indeterminado' if x == 209912 else str(x)
-        )
+        ))
         st.dataframe(
             df_display,
             use_container_width=True,
@@ -2295,17 +2589,17 @@ def render_tab_comparativo(dados: Dict):
     """Renderiza aba de comparativo Entradas vs Saídas."""
     
     # Dados de saída (NFe emitidas)
-    df_nfe_saida = dados.get('nfe_emitidas_resumo', pd.DataFrame())
-    df_ncm_saida = dados.get('top_ncm_nfe', pd.DataFrame())
-    df_cfop_saida = dados.get('cfop_nfe', pd.DataFrame())
+    df_nfe_saida = dados.get('nfe_emitidas_resumo', _DF_VAZIO)
+    df_ncm_saida = dados.get('top_ncm_nfe', _DF_VAZIO)
+    df_cfop_saida_tipo = dados.get('cfop_saida_por_tipo', _DF_VAZIO)
     
     # Dados de entrada (NFe recebidas)
-    df_nfe_entrada = dados.get('nfe_recebidas_resumo', pd.DataFrame())
-    df_ncm_entrada = dados.get('top_ncm_entrada', pd.DataFrame())
-    df_cfop_entrada = dados.get('cfop_entrada', pd.DataFrame())
+    df_nfe_entrada = dados.get('nfe_recebidas_resumo', _DF_VAZIO)
+    df_ncm_entrada = dados.get('top_ncm_entrada', _DF_VAZIO)
+    df_cfop_entrada_tipo = dados.get('cfop_entrada_por_tipo', _DF_VAZIO)
     
     # NFCe (só saída)
-    df_nfce = dados.get('nfce_resumo', pd.DataFrame())
+    df_nfce = dados.get('nfce_resumo', _DF_VAZIO)
     
     # ===========================================
     # RESUMO GERAL
@@ -2347,11 +2641,11 @@ def render_tab_comparativo(dados: Dict):
     
     if not df_nfe_entrada.empty or not df_nfe_saida.empty:
         # Preparar dados
-        df_entrada_mes = df_nfe_entrada[['periodo', 'valor_total']].copy() if not df_nfe_entrada.empty else pd.DataFrame(columns=['periodo', 'valor_total'])
+        df_entrada_mes = df_nfe_entrada[['periodo', 'valor_total']] if not df_nfe_entrada.empty else pd.DataFrame(columns=['periodo', 'valor_total'])
         df_entrada_mes = df_entrada_mes.rename(columns={'valor_total': 'entrada'})
         df_entrada_mes['periodo'] = df_entrada_mes['periodo'].astype(str)
         
-        df_saida_mes = df_nfe_saida[['periodo', 'valor_total']].copy() if not df_nfe_saida.empty else pd.DataFrame(columns=['periodo', 'valor_total'])
+        df_saida_mes = df_nfe_saida[['periodo', 'valor_total']] if not df_nfe_saida.empty else pd.DataFrame(columns=['periodo', 'valor_total'])
         df_saida_mes = df_saida_mes.rename(columns={'valor_total': 'saida_nfe'})
         df_saida_mes['periodo'] = df_saida_mes['periodo'].astype(str)
         
@@ -2360,7 +2654,7 @@ def render_tab_comparativo(dados: Dict):
         
         # Adicionar NFCe se houver
         if not df_nfce.empty:
-            df_nfce_mes = df_nfce[['periodo', 'valor_total']].copy()
+            df_nfce_mes = df_nfce[['periodo', 'valor_total']]
             df_nfce_mes = df_nfce_mes.rename(columns={'valor_total': 'saida_nfce'})
             df_nfce_mes['periodo'] = df_nfce_mes['periodo'].astype(str)
             df_comp = pd.merge(df_comp, df_nfce_mes, on='periodo', how='outer').fillna(0)
@@ -2417,11 +2711,9 @@ def render_tab_comparativo(dados: Dict):
     with col1:
         st.markdown("#### 📥 Top NCM Entradas")
         if not df_ncm_entrada.empty:
-            df_display = df_ncm_entrada.copy()
+            df_display = df_ncm_entrada
             if 'descricao_ncm' in df_display.columns:
-                df_display['descricao_ncm'] = df_display['descricao_ncm'].apply(
-                    lambda x: x[:40] + '...' if len(str(x)) > 40 else x
-                )
+                df_display = df_ncm_entrada.assign(descricao_ncm=truncar_texto_series(df_ncm_entrada['descricao_ncm'], 40))
             max_valor = df_display['valor_total'].max()
             
             st.dataframe(
@@ -2441,11 +2733,9 @@ def render_tab_comparativo(dados: Dict):
     with col2:
         st.markdown("#### 📤 Top NCM Saídas")
         if not df_ncm_saida.empty:
-            df_display = df_ncm_saida.copy()
+            df_display = df_ncm_saida
             if 'descricao_ncm' in df_display.columns:
-                df_display['descricao_ncm'] = df_display['descricao_ncm'].apply(
-                    lambda x: x[:40] + '...' if len(str(x)) > 40 else x
-                )
+                df_display = df_ncm_saida.assign(descricao_ncm=truncar_texto_series(df_ncm_saida['descricao_ncm'], 40))
             max_valor = df_display['valor_total'].max()
             
             st.dataframe(
@@ -2470,36 +2760,26 @@ def render_tab_comparativo(dados: Dict):
         st.markdown("### 💹 Análise de Markup por NCM")
         st.caption("NCMs que aparecem tanto nas entradas quanto nas saídas")
         
-        # Merge por NCM
-        df_entrada_ncm = df_ncm_entrada[['ncm', 'valor_total', 'qtd_itens']].copy()
-        df_entrada_ncm = df_entrada_ncm.rename(columns={'valor_total': 'valor_entrada', 'qtd_itens': 'qtd_entrada'})
-        
-        df_saida_ncm = df_ncm_saida[['ncm', 'valor_total', 'qtd_itens']].copy()
-        df_saida_ncm = df_saida_ncm.rename(columns={'valor_total': 'valor_saida', 'qtd_itens': 'qtd_saida'})
-        
+        # Merge por NCM (só as colunas usadas; um único rename no resultado)
+        colunas_saida = ['ncm', 'valor_total']
         if 'descricao_ncm' in df_ncm_saida.columns:
-            df_saida_ncm['descricao_ncm'] = df_ncm_saida['descricao_ncm']
+            colunas_saida.append('descricao_ncm')
         
-        df_markup = pd.merge(df_entrada_ncm, df_saida_ncm, on='ncm', how='inner')
+        df_markup = df_ncm_entrada[['ncm', 'valor_total']].merge(
+            df_ncm_saida[colunas_saida], on='ncm', how='inner', suffixes=('_entrada', '_saida')
+        ).rename(columns={'valor_total_entrada': 'valor_entrada', 'valor_total_saida': 'valor_saida'})
         
         if not df_markup.empty:
             # Calcular markup
             df_markup['markup_valor'] = df_markup['valor_saida'] - df_markup['valor_entrada']
-            df_markup['markup_pct'] = np.where(
-                df_markup['valor_entrada'] > 0,
-                (df_markup['markup_valor'] / df_markup['valor_entrada']) * 100,
-                0
-            )
+            df_markup['markup_pct'] = percentual_seguro(df_markup['markup_valor'], df_markup['valor_entrada'])
             df_markup = df_markup.sort_values('markup_valor', ascending=False)
             
             # Truncar descrição
             if 'descricao_ncm' in df_markup.columns:
-                df_markup['descricao_ncm'] = df_markup['descricao_ncm'].apply(
-                    lambda x: x[:40] + '...' if len(str(x)) > 40 else x
-                )
+                df_markup['descricao_ncm'] = truncar_texto_series(df_markup['descricao_ncm'], 40)
             
-            max_entrada = df_markup['valor_entrada'].max()
-            max_saida = df_markup['valor_saida'].max()
+            max_entrada, max_saida = df_markup[['valor_entrada', 'valor_saida']].max()
             
             colunas = ['ncm', 'valor_entrada', 'valor_saida', 'markup_valor', 'markup_pct']
             if 'descricao_ncm' in df_markup.columns:
@@ -2520,9 +2800,9 @@ def render_tab_comparativo(dados: Dict):
             )
             
             # Alertas
-            ncms_negativos = df_markup[df_markup['markup_pct'] < 0]
-            if not ncms_negativos.empty:
-                st.warning(f"⚠️ {len(ncms_negativos)} NCM(s) com markup negativo (vendendo por menos do que compra)")
+            qtd_negativos = int((df_markup['markup_pct'] < 0).sum())
+            if qtd_negativos:
+                st.warning(f"⚠️ {qtd_negativos} NCM(s) com markup negativo (vendendo por menos do que compra)")
         else:
             st.info("Não há NCMs em comum entre entradas e saídas para análise de markup.")
     
@@ -2537,28 +2817,9 @@ def render_tab_comparativo(dados: Dict):
     
     with col1:
         st.markdown("#### 📥 CFOPs de Entrada")
-        if not df_cfop_entrada.empty:
-            # Agrupar por tipo
-            def classificar_cfop_entrada(cfop):
-                try:
-                    cfop = int(cfop)
-                    if cfop >= 1000 and cfop < 2000:
-                        return "Interna (1XXX)"
-                    elif cfop >= 2000 and cfop < 3000:
-                        return "Interestadual (2XXX)"
-                    elif cfop >= 3000 and cfop < 4000:
-                        return "Exterior (3XXX)"
-                    else:
-                        return "Outros"
-                except:
-                    return "Outros"
-            
-            df_cfop_entrada['tipo'] = df_cfop_entrada['cfop'].apply(classificar_cfop_entrada)
-            df_resumo = df_cfop_entrada.groupby('tipo').agg({
-                'valor_total': 'sum',
-                'qtd_notas': 'sum'
-            }).reset_index()
-            df_resumo = df_resumo.sort_values('valor_total', ascending=False)
+        if not df_cfop_entrada_tipo.empty:
+            # Agrupado por tipo uma única vez na busca (resumir_cfops_por_tipo)
+            df_resumo = df_cfop_entrada_tipo
             max_valor = df_resumo['valor_total'].max()
             
             st.dataframe(
@@ -2576,28 +2837,9 @@ def render_tab_comparativo(dados: Dict):
     
     with col2:
         st.markdown("#### 📤 CFOPs de Saída")
-        if not df_cfop_saida.empty:
-            # Agrupar por tipo
-            def classificar_cfop_saida(cfop):
-                try:
-                    cfop = int(cfop)
-                    if cfop >= 5000 and cfop < 6000:
-                        return "Interna (5XXX)"
-                    elif cfop >= 6000 and cfop < 7000:
-                        return "Interestadual (6XXX)"
-                    elif cfop >= 7000:
-                        return "Exterior (7XXX)"
-                    else:
-                        return "Outros"
-                except:
-                    return "Outros"
-            
-            df_cfop_saida['tipo'] = df_cfop_saida['cfop'].apply(classificar_cfop_saida)
-            df_resumo = df_cfop_saida.groupby('tipo').agg({
-                'valor_total': 'sum',
-                'qtd_notas': 'sum'
-            }).reset_index()
-            df_resumo = df_resumo.sort_values('valor_total', ascending=False)
+        if not df_cfop_saida_tipo.empty:
+            # Agrupado por tipo uma única vez na busca (resumir_cfops_por_tipo)
+            df_resumo = df_cfop_saida_tipo
             max_valor = df_resumo['valor_total'].max()
             
             st.dataframe(
@@ -2617,7 +2859,7 @@ def render_tab_comparativo(dados: Dict):
 def render_tab_cfop(dados: Dict):
     """Renderiza aba de análise por CFOP - apenas métricas e tabela."""
     
-    df_cfop = dados.get('cfop_nfe', pd.DataFrame())
+    df_cfop = dados.get('cfop_nfe', _DF_VAZIO)
     
     if df_cfop.empty:
         st.warning("""
@@ -2630,61 +2872,17 @@ def render_tab_cfop(dados: Dict):
     
     st.markdown("### 📋 Distribuição por CFOP")
     
-    # Usar classificação da tabela se disponível, senão calcular
-    if 'entrada_saida' in df_cfop.columns and df_cfop['entrada_saida'].notna().any():
-        # Usar dados da tabela de CFOP
-        df_cfop['tipo_operacao'] = df_cfop.apply(
-            lambda x: f"{x['entrada_saida']} {x['local_operacao']}" if pd.notna(x['entrada_saida']) else 'Outros', 
-            axis=1
-        )
-    else:
-        # Classificar manualmente
-        def classificar_cfop(cfop):
-            try:
-                cfop = int(cfop)
-                if cfop >= 1000 and cfop < 2000:
-                    return "Entrada Interna"
-                elif cfop >= 2000 and cfop < 3000:
-                    return "Entrada Interestadual"
-                elif cfop >= 3000 and cfop < 4000:
-                    return "Entrada Exterior"
-                elif cfop >= 5000 and cfop < 6000:
-                    return "Saída Interna"
-                elif cfop >= 6000 and cfop < 7000:
-                    return "Saída Interestadual"
-                elif cfop >= 7000:
-                    return "Saída Exterior"
-                else:
-                    return "Outros"
-            except:
-                return "Outros"
-        df_cfop['tipo_operacao'] = df_cfop['cfop'].apply(classificar_cfop)
-    
     # Métricas resumo
     col1, col2, col3, col4 = st.columns(4)
     
     total_valor = df_cfop['valor_total'].sum()
     total_icms = df_cfop['valor_icms'].sum() if 'valor_icms' in df_cfop.columns else 0
     
-    # Calcular por tipo (usando classificação manual para consistência)
-    def get_tipo_simples(cfop):
-        try:
-            cfop = int(cfop)
-            if cfop >= 5000 and cfop < 6000:
-                return "Saída Interna"
-            elif cfop >= 6000 and cfop < 7000:
-                return "Saída Interestadual"
-            elif cfop >= 7000:
-                return "Saída Exterior"
-            else:
-                return "Outros"
-        except:
-            return "Outros"
-    
-    df_cfop['tipo_simples'] = df_cfop['cfop'].apply(get_tipo_simples)
-    saidas_internas = df_cfop[df_cfop['tipo_simples'] == 'Saída Interna']['valor_total'].sum()
-    saidas_interestaduais = df_cfop[df_cfop['tipo_simples'] == 'Saída Interestadual']['valor_total'].sum()
-    saidas_exterior = df_cfop[df_cfop['tipo_simples'] == 'Saída Exterior']['valor_total'].sum()
+    # Por tipo (classificação manual para consistência), somado uma vez na busca
+    saidas_por_tipo = dados.get('cfop_saida_valor_por_tipo', pd.Series(dtype=np.float64))
+    saidas_internas = saidas_por_tipo.get('Saída Interna', 0)
+    saidas_interestaduais = saidas_por_tipo.get('Saída Interestadual', 0)
+    saidas_exterior = saidas_por_tipo.get('Saída Exterior', 0)
     
     with col1:
         st.metric("Saídas Internas (5XXX)", formatar_moeda(saidas_internas))
@@ -2700,19 +2898,18 @@ def render_tab_cfop(dados: Dict):
     # Tabela completa com descrições
     st.markdown("### 📊 Detalhamento por CFOP")
     
-    df_display = df_cfop.copy()
-    total = df_display['valor_total'].sum()
-    df_display['participacao'] = df_display['valor_total'] / total * 100
+    total = df_cfop['valor_total'].sum()
+    df_display = df_cfop.assign(participacao=df_cfop['valor_total'] / total * 100)
     
     # Truncar descrição se existir
     if 'descricao_cfop' in df_display.columns:
-        df_display['descricao_cfop'] = df_display['descricao_cfop'].apply(
-            lambda x: x[:50] + '...' if len(str(x)) > 50 else x
-        )
+        df_display['descricao_cfop'] = truncar_texto_series(df_display['descricao_cfop'], 50)
     
     # Max para barras
-    max_valor = df_display['valor_total'].max()
-    max_icms = df_display['valor_icms'].max() if 'valor_icms' in df_display.columns else 1
+    if 'valor_icms' in df_display.columns:
+        max_valor, max_icms = df_display[['valor_total', 'valor_icms']].max()
+    else:
+        max_valor, max_icms = df_display['valor_total'].max(), 1
     
     # Selecionar colunas para exibição
     colunas = ['cfop', 'qtd_notas', 'qtd_itens', 'valor_total', 'participacao']
@@ -2744,6 +2941,13 @@ def render_tab_cfop(dados: Dict):
 # FUNÇÃO PRINCIPAL DE BUSCA
 # =============================================================================
 
+def somar_resumo(df: pd.DataFrame) -> Tuple[float, float]:
+    """(qtd_notas, valor_total) somados de um resumo mensal em uma única redução; (0, 0) se vazio."""
+    if df.empty:
+        return 0, 0
+    totais = df[['qtd_notas', 'valor_total']].sum()
+    return totais['qtd_notas'], totais['valor_total']
+
 def buscar_dados_empresa_com_progresso(cnpj: str = None, ie: str = None, periodo_inicio: int = None, periodo_fim: int = None) -> Dict:
     """Busca dados da empresa com barra de progresso visual e logs detalhados."""
     
@@ -2767,7 +2971,6 @@ def buscar_dados_empresa_com_progresso(cnpj: str = None, ie: str = None, periodo
             progress_bar = st.progress(0)
             tempo_text = st.empty()
 
-            total_etapas = 17
             etapa_atual = 0
             tempo_inicio = time.time()
             tempo_etapa_inicio = time.time()
@@ -2809,8 +3012,9 @@ def buscar_dados_empresa_com_progresso(cnpj: str = None, ie: str = None, periodo
                 progress_bar.progress(pct / 100, text=f"{mensagem} ({pct}%)")
                 tempo_text.markdown(f"<p style='text-align: center; color: #666;'>{tempo_texto}</p>", unsafe_allow_html=True)
             
-            # Etapa 1: Cadastro
-            atualizar_progresso("📋 Buscando dados cadastrais...")
+            # Etapa 1: Cadastro. O total de etapas só é conhecido depois dele (a de
+            # setor depende do CNAE), então a barra só avança quando ele termina.
+            progress_bar.progress(0, text="📋 Buscando dados cadastrais...")
             df_cadastro = executar_query_cached(
                 NotasQueries.get_cadastro_query(ie=ie, cnpj=cnpj),
                 _cache_key=f"cadastro_{cnpj}_{ie}"
@@ -2823,138 +3027,74 @@ def buscar_dados_empresa_com_progresso(cnpj: str = None, ie: str = None, periodo
             cnpj_limpo = limpar_cnpj(dados['cadastro'].get('cnpj', ''))
             ie_empresa = dados['cadastro'].get('inscricao_estadual', '')
             cnae = dados['cadastro'].get('cnae', '')
-            cache_prefix = f"{cnpj_limpo}_{periodo_inicio}_{periodo_fim}"
-            
-            # Etapa 2: NFe Emitidas
-            atualizar_progresso("📤 Buscando NFe emitidas...")
-            dados['nfe_emitidas_resumo'] = executar_query_cached(
-                NotasQueries.get_nfe_emitidas_resumo(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"nfe_emit_{cache_prefix}"
-            )
-            
-            # Etapa 3: NFe Recebidas
-            atualizar_progresso("📥 Buscando NFe recebidas...")
-            dados['nfe_recebidas_resumo'] = executar_query_cached(
-                NotasQueries.get_nfe_recebidas_resumo(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"nfe_receb_{cache_prefix}"
-            )
-            
-            # Etapa 4: NFCe
-            atualizar_progresso("🛒 Buscando NFCe...")
-            dados['nfce_resumo'] = executar_query_cached(
-                NotasQueries.get_nfce_resumo(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"nfce_{cache_prefix}"
-            )
-            
-            # Etapa 5: Top Clientes
-            atualizar_progresso("👥 Buscando top clientes...")
-            dados['top_clientes'] = executar_query_cached(
-                NotasQueries.get_top_clientes(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"clientes_{cache_prefix}"
-            )
-            
-            # Etapa 6: Top Fornecedores
-            atualizar_progresso("🏭 Buscando top fornecedores...")
-            dados['top_fornecedores'] = executar_query_cached(
-                NotasQueries.get_top_fornecedores(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"fornec_{cache_prefix}"
-            )
-            
-            # Etapa 7: NCM NFe
-            atualizar_progresso("📦 Buscando NCM NFe...")
-            dados['top_ncm_nfe'] = executar_query_cached(
-                NotasQueries.get_top_ncm_nfe(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"ncm_nfe_{cache_prefix}"
-            )
-            
-            # Etapa 8: NCM NFCe
-            atualizar_progresso("📦 Buscando NCM NFCe...")
-            dados['top_ncm_nfce'] = executar_query_cached(
-                NotasQueries.get_top_ncm_nfce(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"ncm_nfce_{cache_prefix}"
-            )
-            
-            # Etapa 9: Produtos NFe
-            atualizar_progresso("🏷️ Buscando produtos NFe...")
-            dados['top_produtos_nfe'] = executar_query_cached(
-                NotasQueries.get_top_produtos_nfe(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"prod_nfe_{cache_prefix}"
-            )
-            
-            # Etapa 10: Produtos NFCe
-            atualizar_progresso("🏷️ Buscando produtos NFCe...")
-            dados['top_produtos_nfce'] = executar_query_cached(
-                NotasQueries.get_top_produtos_nfce(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"prod_nfce_{cache_prefix}"
-            )
-            
-            # Etapa 11: CFOP
-            atualizar_progresso("📋 Buscando CFOP...")
-            dados['cfop_nfe'] = executar_query_cached(
-                NotasQueries.get_cfop_nfe(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"cfop_{cache_prefix}"
-            )
             
-            # Etapa 12: Tributação
-            atualizar_progresso("💹 Buscando tributação...")
-            dados['tributacao_nfe'] = executar_query_cached(
-                NotasQueries.get_tributacao_nfe(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"trib_{cache_prefix}"
-            )
-            
-            # Etapa 13: NCM Entrada (para comparativo)
-            atualizar_progresso("📥 Buscando NCM de entradas...")
-            dados['top_ncm_entrada'] = executar_query_cached(
-                NotasQueries.get_top_ncm_entrada(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"ncm_entrada_{cache_prefix}"
-            )
-            
-            # Etapa 14: CFOP Entrada (para comparativo)
-            atualizar_progresso("📥 Buscando CFOP de entradas...")
-            dados['cfop_entrada'] = executar_query_cached(
-                NotasQueries.get_cfop_entrada(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"cfop_entrada_{cache_prefix}"
-            )
-            
-            # Etapa 15: Faturamento DIME
-            atualizar_progresso("💰 Buscando faturamento DIME...")
-            dados['faturamento_dime'] = executar_query_cached(
-                NotasQueries.get_faturamento_dime(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"dime_{cache_prefix}"
-            )
+            # Demais etapas: só dependem do cadastro, então são disparadas juntas no pool
+            # e o progresso avança (na thread principal) à medida que cada uma termina.
+            # NFe emitidas e recebidas ficam em queries separadas: cada uma filtra uma
+            # única coluna de CNPJ, o que mantém a poda por min/max do Parquet.
+            executor = get_query_executor()
+            consultas = {
+                'nfe_emitidas_resumo': ("📤 Resumo de NFe emitidas",
+                                        NotasQueries.get_nfe_emitidas_resumo(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'nfe_recebidas_resumo': ("📥 Resumo de NFe recebidas",
+                                         NotasQueries.get_nfe_recebidas_resumo(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'nfce_resumo': ("🧾 Resumo de NFCe",
+                                NotasQueries.get_nfce_resumo(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'top_clientes': ("👥 Top clientes",
+                                 NotasQueries.get_top_clientes(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'top_fornecedores': ("🏭 Top fornecedores",
+                                     NotasQueries.get_top_fornecedores(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'top_ncm_nfe': ("📦 NCM NFe",
+                                NotasQueries.get_top_ncm_nfe(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'top_ncm_nfce': ("📦 NCM NFCe",
+                                 NotasQueries.get_top_ncm_nfce(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'top_produtos_nfe': ("🏷️ Produtos NFe",
+                                     NotasQueries.get_top_produtos_nfe(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'top_produtos_nfce': ("🏷️ Produtos NFCe",
+                                      NotasQueries.get_top_produtos_nfce(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'cfop_nfe': ("📋 CFOP",
+                             NotasQueries.get_cfop_nfe(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'tributacao_nfe': ("💹 Tributação",
+                                   NotasQueries.get_tributacao_nfe(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'top_ncm_entrada': ("📥 NCM de entradas",
+                                    NotasQueries.get_top_ncm_entrada(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'cfop_entrada': ("📥 CFOP de entradas",
+                                 NotasQueries.get_cfop_entrada(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'faturamento_dime': ("💰 Faturamento DIME",
+                                     NotasQueries.get_faturamento_dime(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'faturamento_pgdas': ("💰 Faturamento PGDAS",
+                                      NotasQueries.get_faturamento_pgdas(cnpj_limpo, periodo_inicio, periodo_fim)),
+                'ttd_empresa': ("🎫 TTDs", NotasQueries.get_ttd_empresa(ie_empresa)),
+            }
+            if cnae:
+                consultas['setor_stats'] = ("🏢 Estatísticas do setor",
+                                            NotasQueries.get_setor_stats(cnae, periodo_inicio, periodo_fim))
+            etapas = {
+                executor.submit(executar_query_cached, query): (chave, rotulo)
+                for chave, (rotulo, query) in consultas.items()
+            }
+            total_etapas = 1 + len(etapas)
+            atualizar_progresso("📋 Dados cadastrais ✓")
             
-            # Etapa 16: Faturamento PGDAS
-            atualizar_progresso("💰 Buscando faturamento PGDAS...")
-            dados['faturamento_pgdas'] = executar_query_cached(
-                NotasQueries.get_faturamento_pgdas(cnpj_limpo, periodo_inicio, periodo_fim),
-                _cache_key=f"pgdas_{cache_prefix}"
-            )
+            for futuro in as_completed(etapas):
+                chave, rotulo = etapas[futuro]
+                dados[chave] = resultado_ou_vazio(futuro)
+                atualizar_progresso(f"{rotulo} ✓")
             
-            # Etapa 17: TTDs
-            atualizar_progresso("🎫 Buscando TTDs...")
-            dados['ttd_empresa'] = executar_query_cached(
-                NotasQueries.get_ttd_empresa(ie_empresa),
-                _cache_key=f"ttd_{ie_empresa}"
-            )
+            dados.setdefault('setor_stats', pd.DataFrame())
             
-            # Estatísticas do Setor (extra, não conta no progresso)
-            if cnae:
-                dados['setor_stats'] = executar_query_cached(
-                    NotasQueries.get_setor_stats(cnae, periodo_inicio, periodo_fim),
-                    _cache_key=f"setor_{cnae}_{periodo_inicio}_{periodo_fim}"
-                )
-            else:
-                dados['setor_stats'] = pd.DataFrame()
+            # Resumos de CFOP por tipo (comparativo e métricas da aba CFOP): agrupados
+            # uma vez por busca, e não a cada rerun das abas
+            dados['cfop_entrada_por_tipo'] = resumir_cfops_por_tipo(dados['cfop_entrada'], _CFOP_TIPOS_ENTRADA)
+            dados['cfop_saida_por_tipo'] = resumir_cfops_por_tipo(dados['cfop_nfe'], _CFOP_TIPOS_SAIDA)
+            dados['cfop_saida_valor_por_tipo'] = somar_valor_por_tipo_cfop(dados['cfop_nfe'], _CFOP_TIPOS_SAIDA_SIMPLES)
             
-            # Calcular métricas
-            metricas = {
-                'nfe_emitidas_qtd': dados['nfe_emitidas_resumo']['qtd_notas'].sum() if not dados['nfe_emitidas_resumo'].empty else 0,
-                'nfe_emitidas_valor': dados['nfe_emitidas_resumo']['valor_total'].sum() if not dados['nfe_emitidas_resumo'].empty else 0,
-                'nfe_recebidas_qtd': dados['nfe_recebidas_resumo']['qtd_notas'].sum() if not dados['nfe_recebidas_resumo'].empty else 0,
-                'nfe_recebidas_valor': dados['nfe_recebidas_resumo']['valor_total'].sum() if not dados['nfe_recebidas_resumo'].empty else 0,
-                'nfce_qtd': dados['nfce_resumo']['qtd_notas'].sum() if not dados['nfce_resumo'].empty else 0,
-                'nfce_valor': dados['nfce_resumo']['valor_total'].sum() if not dados['nfce_resumo'].empty else 0,
-            }
+            # Calcular métricas: uma redução (qtd_notas, valor_total) por resumo
+            metricas = {}
+            for prefixo, chave in (('nfe_emitidas', 'nfe_emitidas_resumo'),
+                                   ('nfe_recebidas', 'nfe_recebidas_resumo'),
+                                   ('nfce', 'nfce_resumo')):
+                metricas[f'{prefixo}_qtd'], metricas[f'{prefixo}_valor'] = somar_resumo(dados[chave])
             dados['metricas'] = metricas
     
     # Limpar completamente o placeholder de progresso
@@ -2967,71 +3107,64 @@ def buscar_dados_empresa_com_progresso(cnpj: str = None, ie: str = None, periodo
 # MAIN
 # =============================================================================
 
-def main():
-    """Função principal do aplicativo."""
+@st.fragment
+def render_sidebar():
+    """
+    Renderiza os filtros da sidebar. Por ser um fragmento, alterar CNPJ/IE ou
+    período re-executa apenas a sidebar - as abas só são refeitas no Buscar.
+    """
+    st.markdown("### 🔍 Buscar Empresa")
     
-    # Título - só mostra se não houver dados carregados
-    if 'dados' not in st.session_state:
-        st.markdown("""
-        <div style='text-align: center; padding: 20px 0;'>
-            <h1 style='color: #1e3c72;'>📄 SISTEMA NOTAS</h1>
-            <p style='color: #666;'>Análise de Notas Fiscais Eletrônicas (NFe/NFCe)</p>
-        </div>
-        """, unsafe_allow_html=True)
+    tipo_busca = st.radio("Buscar por:", ["CNPJ", "Inscrição Estadual"], horizontal=True)
     
-    # Sidebar
-    with st.sidebar:
-        st.markdown("### 🔍 Buscar Empresa")
-        
-        tipo_busca = st.radio("Buscar por:", ["CNPJ", "Inscrição Estadual"], horizontal=True)
-        
-        if tipo_busca == "CNPJ":
-            cnpj_input = st.text_input("CNPJ:", placeholder="00.000.000/0000-00")
-            ie_input = None
-        else:
-            ie_input = st.text_input("Inscrição Estadual:", placeholder="000000000")
-            cnpj_input = None
-        
-        st.markdown("---")
-        st.markdown("### 📅 Período de Análise")
-        
-        periodo_inicio_default, periodo_fim_default = calcular_periodo_default()
+    if tipo_busca == "CNPJ":
+        cnpj_input = st.text_input("CNPJ:", placeholder="00.000.000/0000-00")
+        ie_input = None
+    else:
+        ie_input = st.text_input("Inscrição Estadual:", placeholder="000000000")
+        cnpj_input = None
+    
+    st.markdown("---")
+    st.markdown("### 📅 Período de Análise")
+    
+    periodo_inicio_default, periodo_fim_default = calcular_periodo_default()
 
-        # Extrair ano e mês dos valores padrão
-        ano_inicio_default = periodo_inicio_default // 100
-        mes_inicio_default = periodo_inicio_default % 100
-        ano_fim_default = periodo_fim_default // 100
-        mes_fim_default = periodo_fim_default % 100
+    # Extrair ano e mês dos valores padrão
+    ano_inicio_default = periodo_inicio_default // 100
+    mes_inicio_default = periodo_inicio_default % 100
+    ano_fim_default = periodo_fim_default // 100
+    mes_fim_default = periodo_fim_default % 100
 
-        # Lista de anos disponíveis (dinâmica baseada no período)
-        anos_disponiveis = sorted(set([ano_inicio_default, ano_fim_default, 2024, 2025, datetime.now().year]))
+    # Lista de anos disponíveis (dinâmica baseada no período)
+    anos_disponiveis = sorted(set([ano_inicio_default, ano_fim_default, 2024, 2025, datetime.now().year]))
 
-        col1, col2 = st.columns(2)
-        with col1:
-            ano_inicio = st.selectbox("Ano Início:", anos_disponiveis, index=anos_disponiveis.index(ano_inicio_default))
-            mes_inicio = st.selectbox("Mês Início:", range(1, 13), index=mes_inicio_default - 1)
-        with col2:
-            ano_fim = st.selectbox("Ano Fim:", anos_disponiveis, index=anos_disponiveis.index(ano_fim_default))
-            mes_fim = st.selectbox("Mês Fim:", range(1, 13), index=mes_fim_default - 1)
-        
-        periodo_inicio = ano_inicio * 100 + mes_inicio
-        periodo_fim = ano_fim * 100 + mes_fim
-        
-        st.markdown("---")
-        
-        buscar = st.button("🔍 Buscar", type="primary", use_container_width=True)
-        
-        if st.button("🔄 Limpar Cache", use_container_width=True):
-            st.cache_data.clear()
-            st.success("Cache limpo!")
-        
-        # Botão para nova consulta (limpar dados)
-        if 'dados' in st.session_state:
-            if st.button("🔄 Nova Consulta", use_container_width=True):
-                del st.session_state['dados']
-                st.rerun()
+    col1, col2 = st.columns(2)
+    with col1:
+        ano_inicio = st.selectbox("Ano Início:", anos_disponiveis, index=anos_disponiveis.index(ano_inicio_default))
+        mes_inicio = st.selectbox("Mês Início:", range(1, 13), index=mes_inicio_default - 1)
+    with col2:
+        ano_fim = st.selectbox("Ano Fim:", anos_disponiveis, index=anos_disponiveis.index(ano_fim_default))
+        mes_fim = st.selectbox("Mês Fim:", range(1, 13), index=mes_fim_default - 1)
+    
+    periodo_inicio = ano_inicio * 100 + mes_inicio
+    periodo_fim = ano_fim * 100 + mes_fim
+    
+    st.markdown("---")
+    
+    buscar = st.button("🔍 Buscar", type="primary", use_container_width=True)
+    
+    if st.button("🔄 Limpar Cache", use_container_width=True):
+        st.cache_data.clear()
+        limpar_cache_disco()
+        limpar_cache_formatadores()
+        st.success("Cache limpo!")
     
-    # Conteúdo principal
+    # Botão para nova consulta (limpar dados)
+    if 'dados' in st.session_state:
+        if st.button("🔄 Nova Consulta", use_container_width=True):
+            del st.session_state['dados']
+            st.rerun()
+
     if buscar:
         cnpj = limpar_cnpj(cnpj_input) if cnpj_input else None
         ie = limpar_ie(ie_input) if ie_input else None
@@ -3040,17 +3173,40 @@ def main():
             st.error("❌ Informe um CNPJ ou Inscrição Estadual.")
             return
         
-        # Marcar que está iniciando nova busca e limpar dados antigos
+        # Marcar que está iniciando nova busca, limpar dados antigos e re-executar o app inteiro
+        st.session_state['busca'] = {
+            'cnpj': cnpj,
+            'ie': ie,
+            'periodo_inicio': periodo_inicio,
+            'periodo_fim': periodo_fim
+        }
         st.session_state['buscando'] = True
         if 'dados' in st.session_state:
             del st.session_state['dados']
+        st.rerun()
+
+
+def main():
+    """Função principal do aplicativo."""
+    
+    # Título - só mostra se não houver dados carregados
+    if 'dados' not in st.session_state:
+        st.markdown("""
+        <div style='text-align: center; padding: 20px 0;'>
+            <h1 style='color: #1e3c72;'>📄 SISTEMA NOTAS</h1>
+            <p style='color: #666;'>Análise de Notas Fiscais Eletrônicas (NFe/NFCe)</p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    # Sidebar
+    with st.sidebar:
+        render_sidebar()
     
     # Se está no meio de uma busca, executar
     if st.session_state.get('buscando', False):
-        cnpj = limpar_cnpj(cnpj_input) if cnpj_input else None
-        ie = limpar_ie(ie_input) if ie_input else None
+        busca = st.session_state['busca']
         
-        dados = buscar_dados_empresa_com_progresso(cnpj=cnpj, ie=ie, periodo_inicio=periodo_inicio, periodo_fim=periodo_fim)
+        dados = buscar_dados_empresa_com_progresso(**busca)
         
         # Limpar flag de busca
         st.session_state['buscando'] = False
@@ -3060,8 +3216,8 @@ def main():
             return
         
         st.session_state['dados'] = dados
-        st.session_state['periodo_inicio'] = periodo_inicio
-        st.session_state['periodo_fim'] = periodo_fim
+        st.session_state['periodo_inicio'] = busca['periodo_inicio']
+        st.session_state['periodo_fim'] = busca['periodo_fim']
         st.rerun()  # Rerun para aplicar o layout limpo
     
     # Exibir dados se disponíveis